@@ -0,0 +1,131 @@
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+
+import conf
+import metrics
+from logger import logger
+
+MEMINFO_FILENAME = '/proc/meminfo'
+CGROUP_MEMORY_MAX_FILENAME = '/sys/fs/cgroup/memory.max'
+CGROUP_MEMORY_CURRENT_FILENAME = '/sys/fs/cgroup/memory.current'
+
+
+@dataclass
+class VariantLimits:
+    max_running: int
+    # expected peak memory of one proof, see benchmark.py
+    memory_mb: int
+
+
+class AdmissionController:
+    """Decides when the next proof may start, by circuit variant limits, available memory and CPU load."""
+
+    def __init__(
+            self,
+            max_running: int,
+            variants: dict[bool, VariantLimits],
+            memory_reserve_mb: int = 0,
+            max_load_per_cpu: float = 0,
+            ramp_up: float = 0,
+    ):
+        self.max_running = max_running
+        # key - is_2048_sig
+        self.variants = variants
+        self.memory_reserve_mb = memory_reserve_mb
+        self.max_load_per_cpu = max_load_per_cpu
+        self.ramp_up = ramp_up
+
+        self.running = {is_2048_sig: 0 for is_2048_sig in variants}
+        # start time and variant of proofs which could not reach the peak memory yet
+        self._started: list[tuple[float, bool]] = []
+        self._condition = asyncio.Condition()
+
+    @asynccontextmanager
+    async def admit(self, is_2048_sig: bool):
+        async with self._condition:
+            with metrics.timer('prover.admission_wait'):
+                # NOTE: memory and load change without notifications, so they are rechecked periodically
+                while not self.can_admit(is_2048_sig, read_available_memory_mb(), read_load_per_cpu(), time.monotonic()):
+                    try:
+                        await asyncio.wait_for(self._condition.wait(), conf.PROVER_ADMISSION_INTERVAL)
+                    except asyncio.TimeoutError:
+                        pass
+            self.running[is_2048_sig] += 1
+            self._started.append((time.monotonic(), is_2048_sig))
+
+        try:
+            yield
+        finally:
+            async with self._condition:
+                self.running[is_2048_sig] -= 1
+                self._condition.notify_all()
+
+    def can_admit(self, is_2048_sig: bool, available_mb: int | None, load_per_cpu: float | None, now: float) -> bool:
+        # NOTE: recently started proofs are still growing, their expected memory is not available anymore
+        self._started = [(started, v) for started, v in self._started if now - started < self.ramp_up]
+
+        total_running = sum(self.running.values())
+        # NOTE: a single proof is always admitted, otherwise a too small host would never prove anything
+        if total_running == 0:
+            return True
+
+        variant = self.variants[is_2048_sig]
+        if total_running >= self.max_running or self.running[is_2048_sig] >= variant.max_running:
+            return False
+
+        if self.max_load_per_cpu and load_per_cpu is not None and load_per_cpu > self.max_load_per_cpu:
+            logger.info(f'Proof is delayed by CPU load: {load_per_cpu:.2f} per CPU')
+            return False
+
+        if available_mb is not None:
+            growing_mb = sum(self.variants[v].memory_mb for _, v in self._started)
+            if available_mb - self.memory_reserve_mb - growing_mb < variant.memory_mb:
+                logger.info(f'Proof is delayed by memory: available={available_mb}MB growing={growing_mb}MB')
+                return False
+
+        return True
+
+
+def read_available_memory_mb() -> int | None:
+    try:
+        with open(MEMINFO_FILENAME) as file:
+            meminfo = dict(line.split(':', 1) for line in file)
+        available_mb = int(meminfo['MemAvailable'].split()[0]) // 1024
+    except (OSError, KeyError, ValueError):
+        return None
+
+    # NOTE: /proc/meminfo shows the host memory inside a container
+    try:
+        with open(CGROUP_MEMORY_MAX_FILENAME) as file:
+            memory_max = file.read().strip()
+        if memory_max != 'max':
+            with open(CGROUP_MEMORY_CURRENT_FILENAME) as file:
+                memory_current = int(file.read())
+            available_mb = min(available_mb, (int(memory_max) - memory_current) // (1024 * 1024))
+    except (OSError, ValueError):
+        pass
+
+    return available_mb
+
+
+def read_load_per_cpu() -> float | None:
+    try:
+        return os.getloadavg()[0] / os.cpu_count()
+    except OSError:
+        return None
+
+
+def create_admission_controller() -> AdmissionController:
+    return AdmissionController(
+        max_running=conf.PROVER_CONCURRENCY,
+        variants={
+            False: VariantLimits(max_running=conf.PROVER_MAX_1024, memory_mb=conf.PROVER_MEMORY_MB_1024),
+            True: VariantLimits(max_running=conf.PROVER_MAX_2048, memory_mb=conf.PROVER_MEMORY_MB_2048),
+        },
+        memory_reserve_mb=conf.PROVER_MEMORY_RESERVE_MB,
+        max_load_per_cpu=conf.PROVER_MAX_LOAD_PER_CPU,
+        ramp_up=conf.PROVER_ADMISSION_RAMP_UP,
+    )
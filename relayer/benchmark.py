@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+"""Prover throughput benchmark.
+
+Replays fixture emails from tests.py through create_approval_data + generate_zk_proof
+and prints machine-readable JSON:
+
+    python benchmark.py --key-sizes 1024 2048 --concurrency 1 2 4 --proofs 8 --output bench.json
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import resource
+import time
+
+import admission
+import conf
+import prover
+import witness_worker
+from member_message import create_approval_data
+from models import ApprovalData
+from models import Member
+from tests import demo1024_eml
+from tests import demo2048_eml
+
+# key_size: (raw email, member email, relayer email, msg_hash)
+FIXTURES = {
+    1024: (demo1024_eml, 'dry.914@yandex.com', 'ad@oxor.io', 'hHqTyYhaHOM1/52r43r+AeTIo6GQIvXGYZCY0VwjzVo='),
+    2048: (demo2048_eml, 'swoons.00rubbing@icloud.com', 'ad@oxor.io', 'hHqTyYhaHOM1/52r43r+AeTIo6GQIvXGYZCY0VwjzVo='),
+}
+OTHER_MEMBER_EMAILS = ['aa@oxor.io', 'ab@oxor.io', 'ac@oxor.io']
+
+RSS_SAMPLING_INTERVAL = 0.05
+
+
+async def prepare_approval_data(key_size: int) -> ApprovalData:
+    raw_msg, member_email, relayer_email, msg_hash = FIXTURES[key_size]
+    member = Member(id=1, email=member_email, is_active=True, secret='1', hashed_password='')
+    members = [member] + [
+        Member(id=idx + 2, email=email, is_active=True, secret=str(idx + 2), hashed_password='')
+        for idx, email in enumerate(OTHER_MEMBER_EMAILS)
+    ]
+    return await create_approval_data(raw_msg, msg_hash, members, member, relayer_email)
+
+
+class BbRssSampler:
+    """Tracks peak RSS (VmHWM) of every bb process started by the relayer."""
+
+    def __init__(self):
+        self.peak_rss_kb: dict[int, int] = {}
+        self._task: asyncio.Task | None = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> list[int]:
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        return list(self.peak_rss_kb.values())
+
+    async def _run(self):
+        while True:
+            self._sample()
+            await asyncio.sleep(RSS_SAMPLING_INTERVAL)
+
+    def _sample(self):
+        parent_pid = os.getpid()
+        for pid in filter(str.isdigit, os.listdir('/proc')):
+            try:
+                with open(f'/proc/{pid}/stat') as file:
+                    stat = file.read()
+                # NOTE: comm could contain spaces, fields after it are separated by ") "
+                comm = stat[stat.index('(') + 1:stat.rindex(')')]
+                ppid = int(stat[stat.rindex(')') + 2:].split()[1])
+                if comm != 'bb' or ppid != parent_pid:
+                    continue
+
+                with open(f'/proc/{pid}/status') as file:
+                    for line in file:
+                        if line.startswith('VmHWM:'):
+                            rss_kb = int(line.split()[1])
+                            self.peak_rss_kb[int(pid)] = max(rss_kb, self.peak_rss_kb.get(int(pid), 0))
+                            break
+            except (OSError, ValueError):
+                # the process has exited
+                continue
+
+
+def percentile(values: list[float], pct: float) -> float | None:
+    if not values:
+        return None
+    values = sorted(values)
+    # nearest-rank method
+    rank = max(math.ceil(pct / 100 * len(values)), 1)
+    return values[rank - 1]
+
+
+async def run_level(approval_data: ApprovalData, key_size: int, concurrency: int, proofs: int) -> dict:
+    # NOTE: the adaptive prover limits are replaced by the fixed benchmark concurrency level
+    prover.ADMISSION = admission.AdmissionController(
+        max_running=concurrency,
+        variants={is_2048_sig: admission.VariantLimits(max_running=concurrency, memory_mb=0) for is_2048_sig in (False, True)},
+    )
+    await witness_worker.POOL.stop()
+    witness_worker.POOL = witness_worker.WitnessWorkerPool(concurrency)
+    await witness_worker.POOL.start()
+
+    latencies = []
+    failed = 0
+
+    async def prove():
+        nonlocal failed
+        start = time.perf_counter()
+        proved = await prover.generate_zk_proof(approval_data)
+        if proved:
+            latencies.append(time.perf_counter() - start)
+        else:
+            failed += 1
+
+    sampler = BbRssSampler()
+    usage_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.perf_counter()
+    sampler.start()
+
+    await asyncio.gather(*(prove() for _ in range(proofs)))
+
+    wall_seconds = time.perf_counter() - start
+    peak_rss_kb = await sampler.stop()
+    usage_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    # NOTE: finished bb processes only, long-lived witness workers are not included
+    cpu_seconds = (usage_after.ru_utime - usage_before.ru_utime) + (usage_after.ru_stime - usage_before.ru_stime)
+
+    return {
+        'key_size': key_size,
+        'concurrency': concurrency,
+        'proofs': proofs,
+        'failed': failed,
+        'wall_seconds': wall_seconds,
+        'latency_p50_seconds': percentile(latencies, 50),
+        'latency_p95_seconds': percentile(latencies, 95),
+        'proofs_per_minute': len(latencies) / wall_seconds * 60,
+        'bb_peak_rss_mb_max': max(peak_rss_kb) / 1024 if peak_rss_kb else None,
+        'bb_peak_rss_mb_mean': sum(peak_rss_kb) / len(peak_rss_kb) / 1024 if peak_rss_kb else None,
+        'bb_cpu_seconds': cpu_seconds,
+        'cpu_utilisation': cpu_seconds / (wall_seconds * os.cpu_count()),
+    }
+
+
+async def main(key_sizes: list[int], concurrency_levels: list[int], proofs: int) -> dict:
+    # NOTE: every proof has the same input, the cache would return all of them but the first one
+    conf.PROOF_CACHE_ENABLED = False
+    await prover.warm_up()
+
+    runs = []
+    for key_size in key_sizes:
+        approval_data = await prepare_approval_data(key_size)
+        for concurrency in concurrency_levels:
+            runs.append(await run_level(approval_data, key_size, concurrency, proofs))
+
+    await witness_worker.POOL.stop()
+    return {
+        'cpu_count': os.cpu_count(),
+        'runs': runs,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Prover throughput benchmark')
+    parser.add_argument('--key-sizes', type=int, nargs='+', choices=sorted(FIXTURES), default=[1024, 2048])
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--proofs', type=int, default=8, help='number of proofs for every key size and concurrency level')
+    parser.add_argument('--output', help='JSON file, stdout by default')
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    report = loop.run_until_complete(main(args.key_sizes, args.concurrency, args.proofs))
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=4)
+    else:
+        print(json.dumps(report, indent=4))
@@ -6,6 +6,7 @@ from web3.middleware import SignAndSendRawMiddlewareBuilder
 from web3.exceptions import ContractCustomError
 from web3.types import TxReceipt
 
+import metrics
 from logger import logger
 from models import ProofStruct
 from models import TxnData
@@ -26,6 +27,7 @@ def convert_address_from_str(address: str) -> Address:
     )
 
 
+@metrics.timed('blockchain.execute_txn')
 async def execute_txn(
         samm_address: str,
         txn_data: TxnData,
@@ -43,9 +45,6 @@ async def execute_txn(
     logger.info(f'Transaction txn_data: {txn_data}')
     logger.info(f'Transaction proof_structs: {proof_structs}')
 
-    for proof_struct in proof_structs:
-        proof_struct.proof = bytes.fromhex(proof_struct.proof.decode())
-
     # address to,
     # uint256 value,
     # bytes memory data,
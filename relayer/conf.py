@@ -10,6 +10,11 @@ IMAP_HOST = os.environ.get('IMAP_HOST')
 IMAP_PORT = os.environ.get('IMAP_PORT')
 IMAP_IDLE_TIMEOUT = int(os.environ.get('IMAP_IDLE_TIMEOUT'))
 RELAYER_EMAIL = os.environ.get('RELAYER_EMAIL')
+# processed messages are marked by the IMAP keyword and never fetched again (if the server allows keywords)
+IMAP_KEYWORDS_ENABLED = os.environ.get('IMAP_KEYWORDS_ENABLED', 'true').lower() != 'false'
+IMAP_PROCESSED_KEYWORD = os.environ.get('IMAP_PROCESSED_KEYWORD') or '$SammProcessed'
+# passes a failing message is retried before it is skipped, so it does not stall the later mail of its folder
+IMAP_MESSAGE_MAX_ATTEMPTS = int(os.environ.get('IMAP_MESSAGE_MAX_ATTEMPTS') or 5)
 
 RELAYER_ADDRESS = os.environ.get('RELAYER_ADDRESS')
 
@@ -17,4 +22,90 @@ GMAIL_REFRESH_TOKEN = os.environ.get('GMAIL_REFRESH_TOKEN')
 GMAIL_CLIENT_ID = os.environ.get('GMAIL_CLIENT_ID')
 GMAIL_CLIENT_SECRET = os.environ.get('GMAIL_CLIENT_SECRET')
 
-SAMM_APP_URL = os.environ.get('SAMM_APP_URL')
\ No newline at end of file
+# every folder of every relayer mailbox is watched by its own IMAP connection, e.g. INBOX,[Gmail]/Spam
+IMAP_FOLDERS = [folder.strip() for folder in (os.environ.get('IMAP_FOLDERS') or 'INBOX').split(',') if folder.strip()]
+# relayer mailboxes besides RELAYER_EMAIL: email:refresh_token,... (GMAIL_CLIENT_ID/SECRET are shared)
+IMAP_EXTRA_ACCOUNTS = dict(
+    (email.strip().lower(), refresh_token.strip())
+    for email, refresh_token in (
+        account.split(':', 1) for account in (os.environ.get('IMAP_EXTRA_ACCOUNTS') or '').split(',') if account.strip()
+    )
+)
+
+SAMM_APP_URL = os.environ.get('SAMM_APP_URL')
+
+# max number of proofs generated simultaneously, the admission by memory and CPU load limits them on small hosts
+PROVER_CONCURRENCY = int(os.environ.get('PROVER_CONCURRENCY') or os.cpu_count() or 1)
+# per circuit variant limits, a proof waits until both its variant and the total limits allow it
+PROVER_MAX_1024 = int(os.environ.get('PROVER_MAX_1024') or PROVER_CONCURRENCY)
+PROVER_MAX_2048 = int(os.environ.get('PROVER_MAX_2048') or PROVER_CONCURRENCY)
+# expected peak memory of a single proof (measure with benchmark.py), a proof starts only if it fits into free memory
+PROVER_MEMORY_MB_1024 = int(os.environ.get('PROVER_MEMORY_MB_1024') or 2048)
+PROVER_MEMORY_MB_2048 = int(os.environ.get('PROVER_MEMORY_MB_2048') or 4096)
+# memory left for the relayer and other processes
+PROVER_MEMORY_RESERVE_MB = int(os.environ.get('PROVER_MEMORY_RESERVE_MB') or 512)
+# 1-minute load average per CPU above which new proofs wait (0 - disabled)
+PROVER_MAX_LOAD_PER_CPU = float(os.environ.get('PROVER_MAX_LOAD_PER_CPU') or 2)
+# seconds until a started proof is expected to reach its peak memory
+PROVER_ADMISSION_RAMP_UP = int(os.environ.get('PROVER_ADMISSION_RAMP_UP') or 30)
+# seconds between memory and load rechecks of a waiting proof
+PROVER_ADMISSION_INTERVAL = int(os.environ.get('PROVER_ADMISSION_INTERVAL') or 2)
+# parent directory for per-proof scratch directories (system temp dir by default)
+PROVER_WORKDIR = os.environ.get('PROVER_WORKDIR') or None
+# pass the witness to bb via an in-memory file instead of the scratch directory (Linux only)
+PROVER_WITNESS_MEMFD = hasattr(os, 'memfd_create') and os.environ.get('PROVER_WITNESS_MEMFD', 'true').lower() != 'false'
+# verify every proof with bb before it is stored
+PROVER_VERIFY_PROOFS = os.environ.get('PROVER_VERIFY_PROOFS', 'true').lower() != 'false'
+# number of long-lived node processes generating witnesses
+WITNESS_WORKERS = int(os.environ.get('WITNESS_WORKERS') or min(PROVER_CONCURRENCY, 4))
+
+# "local" - proofs are generated by this process, "remote" - by prover nodes (prover_node.py)
+PROVER_BACKEND = os.environ.get('PROVER_BACKEND') or 'local'
+# comma separated prover node URLs: http://host:port or unix:///path/to/socket
+PROVER_NODES = [url.strip() for url in (os.environ.get('PROVER_NODES') or '').split(',') if url.strip()]
+# max seconds of a single proof request to a prover node
+PROVER_NODE_TIMEOUT = int(os.environ.get('PROVER_NODE_TIMEOUT') or 600)
+# seconds between prover node status requests
+PROVER_NODE_STATUS_INTERVAL = int(os.environ.get('PROVER_NODE_STATUS_INTERVAL') or 5)
+# shared secret of the relayer and prover nodes, prover data contains member secrets
+PROVER_NODE_TOKEN = os.environ.get('PROVER_NODE_TOKEN')
+# prover node service address, the unix socket is used instead of host:port if it is set
+PROVER_NODE_HOST = os.environ.get('PROVER_NODE_HOST') or '127.0.0.1'
+PROVER_NODE_PORT = int(os.environ.get('PROVER_NODE_PORT') or 8100)
+PROVER_NODE_SOCKET = os.environ.get('PROVER_NODE_SOCKET')
+
+# generated proofs are stored by their input, so a reprocessed message does not pay for the proof again
+PROOF_CACHE_ENABLED = os.environ.get('PROOF_CACHE_ENABLED', 'true').lower() != 'false'
+PROOF_CACHE_DIR = os.environ.get('PROOF_CACHE_DIR') or 'proof_cache'
+PROOF_CACHE_MAX_SIZE = int(os.environ.get('PROOF_CACHE_MAX_SIZE_MB') or 256) * 1024 * 1024
+# seconds, 7 days by default
+PROOF_CACHE_MAX_AGE = int(os.environ.get('PROOF_CACHE_MAX_AGE') or 7 * 24 * 60 * 60)
+
+# processes which parse, DKIM-verify and assemble member messages off the event loop (0 - in the event loop)
+MESSAGE_WORKERS = int(os.environ.get('MESSAGE_WORKERS') or min(os.cpu_count() or 1, 4))
+
+# IMAP ingestion pipeline: workers of the stages, which verify messages (DKIM, DB checks),
+# assemble approval data and store proof jobs, and the max number of messages waiting between stages
+INGEST_VERIFY_WORKERS = int(os.environ.get('INGEST_VERIFY_WORKERS') or 8)
+INGEST_BUILD_WORKERS = int(os.environ.get('INGEST_BUILD_WORKERS') or max(MESSAGE_WORKERS, 1))
+INGEST_ENQUEUE_WORKERS = int(os.environ.get('INGEST_ENQUEUE_WORKERS') or 2)
+INGEST_QUEUE_SIZE = int(os.environ.get('INGEST_QUEUE_SIZE') or 16)
+# coroutines which send the responses of processed proof jobs
+NOTIFY_WORKERS = int(os.environ.get('NOTIFY_WORKERS') or 2)
+
+# number of coroutines which claim and process proof jobs
+PROOF_WORKERS = int(os.environ.get('PROOF_WORKERS') or PROVER_CONCURRENCY)
+# max seconds an idle proof worker waits before checking the queue again
+PROOF_JOB_POLL_INTERVAL = int(os.environ.get('PROOF_JOB_POLL_INTERVAL') or 10)
+PROOF_JOB_MAX_ATTEMPTS = int(os.environ.get('PROOF_JOB_MAX_ATTEMPTS') or 3)
+# seconds, deadlines further than the horizon do not make a job more urgent
+PROOF_JOB_DEADLINE_HORIZON = int(os.environ.get('PROOF_JOB_DEADLINE_HORIZON') or 24 * 60 * 60)
+# seconds of deadline slack worth one missing approval to the txn threshold
+PROOF_JOB_APPROVAL_WEIGHT = int(os.environ.get('PROOF_JOB_APPROVAL_WEIGHT') or 60 * 60)
+
+# local Prometheus endpoint http://METRICS_HOST:METRICS_PORT/metrics (disabled if the port is not set)
+METRICS_HOST = os.environ.get('METRICS_HOST') or '127.0.0.1'
+METRICS_PORT = int(os.environ.get('METRICS_PORT') or 0)
+# file for periodical metrics dump (disabled if not set)
+METRICS_FILE = os.environ.get('METRICS_FILE')
+METRICS_DUMP_INTERVAL = int(os.environ.get('METRICS_DUMP_INTERVAL') or 60)
@@ -1,25 +1,36 @@
+from collections import Counter
 from datetime import datetime
 from datetime import timezone
 from random import randint
 from sqlmodel import select
 from sqlalchemy import func
+from sqlalchemy import update
 from sqlalchemy.orm import selectinload
 from sqlalchemy.ext.asyncio import AsyncSession
 
+import metrics
+import proof_scheduler
 from db import engine
 from models import Approval
+from models import MailboxState
 from models import Member
+from models import MessageUid
+from models import ProofJob
+from models import ProofJobCandidate
+from models import ProofJobStatus
 from models import Samm
 from models import Txn
 from models import TxnStatus
 from models import TxnOperation
 from models import InitialData
 from models import ProofStruct
+from logger import logger
 
 
 DEFAULT_EXPIRATION_PERIOD = 30 * 24 * 60 * 60
 
 
+@metrics.timed('crud.create_txn')
 async def create_txn(initial_data: InitialData) -> Txn:
     txn = Txn(
         msg_hash=initial_data.msg_hash,
@@ -43,6 +54,7 @@ async def create_txn(initial_data: InitialData) -> Txn:
         return txn
 
 
+@metrics.timed('crud.change_txn_status')
 async def change_txn_status(txn_id: int, status: TxnStatus) -> Txn:
     async with AsyncSession(engine) as session:
         statement = select(Txn).where(Txn.id == txn_id)
@@ -56,7 +68,14 @@ async def change_txn_status(txn_id: int, status: TxnStatus) -> Txn:
         return tx
 
 
-async def create_approval(txn: Txn, member: Member, proof_struct: ProofStruct, uid: int) -> Approval:
+@metrics.timed('crud.create_approval')
+async def create_approval(
+        txn: Txn,
+        member: Member,
+        proof_struct: ProofStruct,
+        uid: MessageUid,
+        is_verified: bool = False,
+) -> Approval:
     approval = Approval(
         txn_id=txn.id,
         member_id=member.id,
@@ -66,7 +85,11 @@ async def create_approval(txn: Txn, member: Member, proof_struct: ProofStruct, u
         pubkey_hash=proof_struct.pubkeyHash,
         is_2048_sig=proof_struct.is2048sig,
         created_at=datetime.now(),
-        email_uid=uid,
+        email_uid=uid.uid,
+        account=uid.account,
+        folder=uid.folder,
+        uid_validity=uid.uid_validity,
+        is_verified=is_verified,
     )
     async with AsyncSession(engine) as session:
         session.add(approval)
@@ -76,6 +99,7 @@ async def create_approval(txn: Txn, member: Member, proof_struct: ProofStruct, u
     return approval
 
 
+@metrics.timed('crud.get_members_by_samm')
 async def get_members_by_samm(samm_id: int):
     async with AsyncSession(engine) as session:
         statement = select(Member).where(Member.samms.any(id=samm_id))
@@ -83,6 +107,7 @@ async def get_members_by_samm(samm_id: int):
         return results.all()
 
 
+@metrics.timed('crud.get_members_by_txn')
 async def get_members_by_txn(txn_id: int):
     async with AsyncSession(engine) as session:
         statement = select(Member).where(Member.txns.any(id=txn_id))
@@ -90,6 +115,15 @@ async def get_members_by_txn(txn_id: int):
         return results.all()
 
 
+@metrics.timed('crud.get_member_by_id')
+async def get_member_by_id(member_id: int) -> Member:
+    async with AsyncSession(engine) as session:
+        statement = select(Member).where(Member.id == member_id)
+        results = await session.scalars(statement)
+        return results.first()
+
+
+@metrics.timed('crud.get_member_by_email')
 async def get_member_by_email(member_email: str) -> Member:
     async with AsyncSession(engine) as session:
         statement = select(Member).where(Member.email == member_email.lower())
@@ -97,6 +131,52 @@ async def get_member_by_email(member_email: str) -> Member:
         return results.first()
 
 
+@metrics.timed('crud.get_member_emails')
+async def get_member_emails(emails: set[str]) -> set[str]:
+    """The given emails (in lower case) which belong to members."""
+    if not emails:
+        return set()
+    async with AsyncSession(engine) as session:
+        statement = select(Member.email).where(Member.email.in_(emails))
+        results = await session.scalars(statement)
+        return set(results.all())
+
+
+@metrics.timed('crud.get_mailbox_states')
+async def get_mailbox_states(account: str) -> dict[str, MailboxState]:
+    """Sync states of the account folders by folder name."""
+    async with AsyncSession(engine) as session:
+        statement = select(MailboxState).where(MailboxState.account == account)
+        results = await session.scalars(statement)
+        return {state.folder: state for state in results.all()}
+
+
+@metrics.timed('crud.save_mailbox_state')
+async def save_mailbox_state(account: str, folder: str, uid_validity: int, last_uid: int):
+    async with AsyncSession(engine) as session:
+        await session.merge(MailboxState(
+            account=account,
+            folder=folder,
+            uid_validity=uid_validity,
+            last_uid=last_uid,
+            updated_at=datetime.now(),
+        ))
+        await session.commit()
+
+
+@metrics.timed('crud.set_missing_uid_validity')
+async def set_missing_uid_validity(account: str, folder: str, uid_validity: int):
+    """The messages stored before the folder state belong to the current UIDVALIDITY of the folder."""
+    async with AsyncSession(engine) as session:
+        for table in (Approval, ProofJob):
+            statement = update(table).where(
+                (table.account == account) & (table.folder == folder) & (table.uid_validity.is_(None))
+            ).values(uid_validity=uid_validity)
+            await session.execute(statement)
+        await session.commit()
+
+
+@metrics.timed('crud.get_txn_by_msg_hash')
 async def get_txn_by_msg_hash(msg_hash: str) -> Txn:
     async with AsyncSession(engine) as session:
         statement = select(Txn).where(Txn.msg_hash == msg_hash).options(selectinload(Txn.samm))
@@ -104,13 +184,15 @@ async def get_txn_by_msg_hash(msg_hash: str) -> Txn:
         return results.first()
 
 
-async def get_approval_by_uid(email_uid: int) -> Approval:
+@metrics.timed('crud.get_approval_by_uid')
+async def get_approval_by_uid(uid: MessageUid) -> Approval:
     async with AsyncSession(engine) as session:
-        statement = select(Approval).where(Approval.email_uid == email_uid)
+        statement = select(Approval).where(_message_uid_filter(Approval, uid))
         results = await session.scalars(statement)
         return results.first()
 
 
+@metrics.timed('crud.get_approval_by_txn_and_email')
 async def get_approval_by_txn_and_email(txn_id: int, member_id: int) -> Approval:
     async with AsyncSession(engine) as session:
         statement = select(Approval).where(
@@ -120,6 +202,7 @@ async def get_approval_by_txn_and_email(txn_id: int, member_id: int) -> Approval
         return results.first()
 
 
+@metrics.timed('crud.check_threshold_is_confirmed')
 async def check_threshold_is_confirmed(txn_id: int, samm_id: int) -> bool:
     async with AsyncSession(engine) as session:
         # TODO: replace samm.threshold to tx.threshold at the moment of tx creation
@@ -137,6 +220,7 @@ async def check_threshold_is_confirmed(txn_id: int, samm_id: int) -> bool:
         return approval_count >= threshold
 
 
+@metrics.timed('crud.get_approvals')
 async def get_approvals(txn_id: int):
     async with AsyncSession(engine) as session:
         statement = select(Approval).where(
@@ -146,6 +230,160 @@ async def get_approvals(txn_id: int):
         return results.all()
 
 
+@metrics.timed('crud.create_proof_job')
+async def create_proof_job(
+        uid: MessageUid,
+        member_id: int,
+        msg_hash: str,
+        initial_data: dict | None,
+        approval_data: dict,
+) -> ProofJob:
+    now = datetime.now()
+    job = ProofJob(
+        email_uid=uid.uid,
+        account=uid.account,
+        folder=uid.folder,
+        uid_validity=uid.uid_validity,
+        member_id=member_id,
+        msg_hash=msg_hash,
+        initial_data=initial_data,
+        approval_data=approval_data,
+        status=ProofJobStatus.pending,
+        created_at=now,
+        updated_at=now,
+    )
+    async with AsyncSession(engine) as session:
+        session.add(job)
+        await session.commit()
+        await session.refresh(job)
+        return job
+
+
+@metrics.timed('crud.get_proof_job_by_uid')
+async def get_proof_job_by_uid(uid: MessageUid) -> ProofJob:
+    async with AsyncSession(engine) as session:
+        statement = select(ProofJob).where(_message_uid_filter(ProofJob, uid))
+        results = await session.scalars(statement)
+        return results.first()
+
+
+def _message_uid_filter(table: type[Approval] | type[ProofJob], uid: MessageUid):
+    # NOTE: the same UID is used by other folders and by the folder after a UIDVALIDITY change
+    return (
+        (table.email_uid == uid.uid)
+        & (table.account == uid.account)
+        & (table.folder == uid.folder)
+        & (table.uid_validity == uid.uid_validity)
+    )
+
+
+@metrics.timed('crud.claim_proof_job')
+async def claim_proof_job(candidates_limit: int = 1000) -> ProofJob | None:
+    async with AsyncSession(engine) as session:
+        candidates = await _get_proof_job_candidates(session, candidates_limit)
+        scheduled, dropped = proof_scheduler.schedule(candidates, datetime.now().timestamp())
+
+        for candidate, reason in dropped:
+            statement = update(ProofJob).where(
+                (ProofJob.id == candidate.job_id) & (ProofJob.status == ProofJobStatus.pending)
+            ).values(
+                status=ProofJobStatus.failed,
+                error=reason,
+                updated_at=datetime.now(),
+            )
+            await session.execute(statement)
+            await session.commit()
+            logger.warning(f'Proof job is dropped: id={candidate.job_id} {reason}')
+
+        for candidate in scheduled:
+            # NOTE: conditional update, so the job is claimed by a single worker even without row locks
+            statement = update(ProofJob).where(
+                (ProofJob.id == candidate.job_id) & (ProofJob.status == ProofJobStatus.pending)
+            ).values(
+                status=ProofJobStatus.processing,
+                attempts=ProofJob.attempts + 1,
+                updated_at=datetime.now(),
+            )
+            result = await session.execute(statement)
+            await session.commit()
+            if result.rowcount == 1:
+                return await session.get(ProofJob, candidate.job_id)
+
+    return None
+
+
+async def _get_proof_job_candidates(session: AsyncSession, limit: int) -> list[ProofJobCandidate]:
+    # NOTE: approval_data is not loaded, it is large and not needed for scheduling
+    statement = select(
+        ProofJob.id, ProofJob.msg_hash, ProofJob.initial_data, ProofJob.created_at
+    ).where(
+        ProofJob.status == ProofJobStatus.pending
+    ).order_by(ProofJob.id).limit(limit)
+    jobs = (await session.execute(statement)).all()
+    if not jobs:
+        return []
+
+    statement = select(Txn).where(Txn.msg_hash.in_({job.msg_hash for job in jobs}))
+    txns = {txn.msg_hash: txn for txn in (await session.scalars(statement)).all()}
+
+    samm_ids = {txn.samm_id for txn in txns.values()} | {job.initial_data['samm_id'] for job in jobs if job.initial_data}
+    statement = select(Samm.id, Samm.threshold).where(Samm.id.in_(samm_ids))
+    thresholds = dict((await session.execute(statement)).all())
+
+    statement = select(Approval.txn_id, func.count(Approval.id)).where(
+        Approval.txn_id.in_([txn.id for txn in txns.values()])
+    ).group_by(Approval.txn_id)
+    approvals = dict((await session.execute(statement)).all())
+
+    pending_jobs = Counter(job.msg_hash for job in jobs)
+
+    candidates = []
+    for job in jobs:
+        candidate = ProofJobCandidate(job_id=job.id, created_at=job.created_at, pending_jobs=pending_jobs[job.msg_hash])
+        if txn := txns.get(job.msg_hash):
+            candidate.txn_status = txn.status
+            candidate.deadline = txn.deadline
+            candidate.threshold = thresholds.get(txn.samm_id)
+            candidate.approvals = approvals.get(txn.id, 0)
+        elif job.initial_data:
+            candidate.deadline = job.initial_data['txn_data']['deadline']
+            candidate.threshold = thresholds.get(job.initial_data['samm_id'])
+        candidates.append(candidate)
+
+    return candidates
+
+
+@metrics.timed('crud.change_proof_job_status')
+async def change_proof_job_status(job_id: int, status: ProofJobStatus, error: str | None = None) -> ProofJob:
+    async with AsyncSession(engine) as session:
+        statement = select(ProofJob).where(ProofJob.id == job_id)
+        results = await session.scalars(statement)
+        job = results.one()
+
+        job.status = status
+        job.error = error
+        job.updated_at = datetime.now()
+        session.add(job)
+        await session.commit()
+        await session.refresh(job)
+        return job
+
+
+@metrics.timed('crud.reset_processing_proof_jobs')
+async def reset_processing_proof_jobs() -> int:
+    # NOTE: jobs which were claimed before restart are returned to the queue
+    async with AsyncSession(engine) as session:
+        statement = update(ProofJob).where(
+            ProofJob.status == ProofJobStatus.processing
+        ).values(
+            status=ProofJobStatus.pending,
+            updated_at=datetime.now(),
+        )
+        result = await session.execute(statement)
+        await session.commit()
+        return result.rowcount
+
+
 def _random_secret() -> str:
     return str(randint(
         1267650600228229401496703205377,
@@ -1,7 +1,22 @@
 import os
+from datetime import datetime
 from sqlmodel import SQLModel
+from sqlalchemy import insert
+from sqlalchemy import inspect
+from sqlalchemy import select
+from sqlalchemy import text
+from sqlalchemy import update
 from sqlalchemy.ext.asyncio import create_async_engine
 
+import conf
+from models import Approval
+from models import DataMigration
+from models import ProofJob
+from logger import logger
+
+HEX_DIGITS = frozenset(b'0123456789abcdef')
+MIGRATION_BATCH_SIZE = 100
+
 
 DATABASE_URL = os.environ.get('DATABASE_URL')
 
@@ -19,4 +34,66 @@ async def init_db():
     async with engine.begin() as conn:
         await conn.run_sync(SQLModel.metadata.drop_all)
         await conn.run_sync(SQLModel.metadata.create_all)
+        # NOTE: a new database has nothing to migrate
+        await conn.run_sync(_apply_data_migrations)
+
+
+async def upgrade_db():
+    # NOTE: existing data is not touched, only new tables and columns are created
+    async with engine.begin() as conn:
+        await conn.run_sync(SQLModel.metadata.create_all)
+        await conn.run_sync(_add_missing_columns)
+        await conn.run_sync(_apply_data_migrations)
+
+
+def _add_missing_columns(conn):
+    inspector = inspect(conn)
+    for table in SQLModel.metadata.sorted_tables:
+        existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing_columns:
+                continue
+
+            column_type = column.type.compile(dialect=conn.dialect)
+            statement = f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'
+            if column.server_default is not None:
+                default = column.server_default.arg.compile(dialect=conn.dialect)
+                statement += f' DEFAULT {default}'
+            logger.info(f'Add column: {table.name}.{column.name}')
+            conn.execute(text(statement))
+
+
+def _apply_data_migrations(conn):
+    applied = set(conn.execute(select(DataMigration.name)).scalars())
+    for name, migration in DATA_MIGRATIONS:
+        if name in applied:
+            continue
+        logger.info(f'Apply data migration: {name}')
+        migration(conn)
+        conn.execute(insert(DataMigration).values(name=name, applied_at=datetime.now()))
+
+
+def _convert_hex_proofs(conn):
+    # NOTE: proofs were stored as hex encoded ASCII, raw proofs could not consist of hex digits only
+    last_id = 0
+    while rows := conn.execute(
+        select(Approval.id, Approval.proof).where(Approval.id > last_id).order_by(Approval.id).limit(MIGRATION_BATCH_SIZE)
+    ).all():
+        for approval_id, proof in rows:
+            if proof and len(proof) % 2 == 0 and HEX_DIGITS.issuperset(proof):
+                conn.execute(update(Approval).where(Approval.id == approval_id).values(proof=bytes.fromhex(proof.decode())))
+        last_id = rows[-1].id
+
+
+def _assign_message_uids(conn):
+    # NOTE: only INBOX of the relayer email was watched before, its UIDVALIDITY is set by the first SELECT
+    # (see crud.set_missing_uid_validity)
+    for table in (Approval, ProofJob):
+        conn.execute(update(table).where(table.account.is_(None)).values(account=conf.RELAYER_EMAIL, folder='INBOX'))
+
 
+# NOTE: every migration is applied once, so the names must not be changed
+DATA_MIGRATIONS = [
+    ('approval_proof_hex_to_raw', _convert_hex_proofs),
+    ('message_uid_mailbox', _assign_message_uids),
+]
@@ -1,15 +1,30 @@
 import aiohttp
 import asyncio
 import re
+from email import policy
+from email.message import Message
+from email.parser import BytesParser
+from email.utils import parseaddr
 from itertools import batched
 
 from aioimaplib import aioimaplib
 
 import conf
+import crud
+import proof_jobs
+from mailer import dkim_keys
+from mailer.dkim_extractor import get_message_key_name
 from models import MailboxCursor
-from member_message import parse_member_message
-from member_message import process_member_message
-from member_message import send_response_by_member_message
+from models import MailboxState
+from models import MemberMessage
+from models import MessageUid
+from models import VerifiedMessage
+from member_message import build_member_message
+from member_message import is_msg_hash_format
+from member_message import is_relayer_email
+from member_message import verify_member_message
+from pipeline import Pipeline
+from pipeline import Stage
 from logger import logger
 
 # https://github.com/bamthomas/aioimaplib
@@ -17,64 +32,168 @@ from logger import logger
 
 FETCH_COMMAND = 'fetch'
 FETCH_CRITERIA_PARTS = '(UID RFC822)'
+# NOTE: PEEK does not set the \Seen flag
+FETCH_HEADERS_PARTS = '(UID BODY.PEEK[HEADER.FIELDS (FROM TO SUBJECT DKIM-SIGNATURE)])'
 
 FETCH_MESSAGE_DATA_SEQNUM = re.compile(rb'(?P<seqnum>\d+) FETCH.*')
 FETCH_MESSAGE_DATA_UID = re.compile(rb'.*UID (?P<uid>\d+).*')
 FETCH_MESSAGE_DATA_FLAGS = re.compile(rb'.*FLAGS \((?P<flags>.*?)\).*')
+SELECT_UIDVALIDITY = re.compile(rb'\[UIDVALIDITY (?P<uid_validity>\d+)\]')
+SELECT_UIDNEXT = re.compile(rb'\[UIDNEXT (?P<uid_next>\d+)\]')
+SELECT_PERMANENTFLAGS = re.compile(rb'\[PERMANENTFLAGS \((?P<flags>.*?)\)\]')
 
 CHUNK_SIZE = 100
 
+# relayer mailbox email -> Gmail OAuth refresh token
+ACCOUNTS = {conf.RELAYER_EMAIL: conf.GMAIL_REFRESH_TOKEN, **conf.IMAP_EXTRA_ACCOUNTS}
+
+# NOTE: one IDLE loop per cursor, the UID ranges are resumed from the mailbox states (see select_folder)
 CURSORS = [
-    # MailboxCursor(folder='Spam', uid_start=95, uid_end=95 + CHUNK_SIZE),
-    MailboxCursor(folder='INBOX', uid_start=1, uid_end=540 + CHUNK_SIZE),
+    MailboxCursor(account=account, folder=folder, uid_start=1, uid_end=CHUNK_SIZE)
+    for account in ACCOUNTS
+    for folder in conf.IMAP_FOLDERS
 ]
 
+# NOTE: failed passes of the messages which are retried, the counters are reset by a restart
+FAILED_ATTEMPTS: dict[MessageUid, int] = {}
+
+
+async def _verify(item: tuple[MessageUid, bytes, bool]) -> VerifiedMessage | None:
+    uid, raw_msg, check_uid = item
+    logger.info(f'====== Parse raw message: UID={uid}')
+    return await verify_member_message(uid, raw_msg, check_uid)
+
+
+async def _build(verified: VerifiedMessage) -> tuple[MessageUid, MemberMessage]:
+    return verified.uid, await build_member_message(verified)
+
+
+async def _enqueue(item: tuple[MessageUid, MemberMessage]):
+    # NOTE: proving, storing and execution are done by proof workers
+    await proof_jobs.enqueue(*item)
+
 
-async def idle_loop():
-    imap_client = await connect()
+# NOTE: the messages of a chunk overlap: DB and DNS waits of some messages with CPU work (message workers) of others
+INGESTION = Pipeline(
+    'ingest',
+    [
+        Stage('verify', _verify, conf.INGEST_VERIFY_WORKERS),
+        Stage('build', _build, conf.INGEST_BUILD_WORKERS),
+        Stage('enqueue', _enqueue, conf.INGEST_ENQUEUE_WORKERS),
+    ],
+    queue_size=conf.INGEST_QUEUE_SIZE,
+)
 
-    cursor = CURSORS[0]
-    switch_folder = True
+
+async def idle_loop(cursor: MailboxCursor):
+    """Watches one folder of one mailbox on its own connection, all loops feed the same INGESTION pipeline."""
+    imap_client = await connect(cursor.account)
+    # NOTE: one query per connection, the folder is not replayed from the first UID
+    states = await crud.get_mailbox_states(cursor.account)
+    # NOTE: a chunk could be enqueued, but not marked by the keyword before a crash, the first one is checked by DB
+    resumed = False
+    select = True
 
     while True:
         try:
-            if switch_folder:
-                idx = CURSORS.index(cursor)
-                cursor = CURSORS[0] if (idx + 1) >= len(CURSORS) else CURSORS[idx + 1]
-                resp = await imap_client.select(cursor.folder)
-                switch_folder = False
-                logger.info(f'Select mail folder: {cursor.folder}')
-
-            uid_max = await fetch_imap_messages(imap_client, cursor.uid_start, cursor.uid_end)
-            match uid_max:
-                case 0:
-                    switch_folder = True
-                case cursor.uid_end:
-                    cursor.uid_start += CHUNK_SIZE
-                    cursor.uid_end += CHUNK_SIZE
-                    switch_folder = True
-                case _:
-                    cursor.uid_start = uid_max + 1
-                    cursor.uid_end = uid_max + CHUNK_SIZE
+            if select:
+                # NOTE: UIDNEXT and UIDVALIDITY are refreshed after IDLE
+                await select_folder(imap_client, cursor, states)
+                select = False
+                logger.info(f'Select mail folder: {cursor.account} {cursor.folder} UIDs={cursor.uid_start}:{cursor.uid_end}')
+
+            # NOTE: the messages of a folder without a state were not marked by the keyword, they are checked by DB
+            check_uid = not cursor.keywords or not resumed or cursor.folder not in states
+            uid_max, uid_failed = await fetch_imap_messages(imap_client, cursor, check_uid=check_uid)
+            resumed = True
+            if uid_max:
+                # NOTE: the chunk is processed up to the first failed message, see process_imap_messages
+                await crud.save_mailbox_state(cursor.account, cursor.folder, cursor.uid_validity, uid_max)
+
+            if uid_failed:
+                # NOTE: the next pass retries the failed message, the later ones are skipped by the keyword or DB
+                move_cursor(cursor, uid_failed)
+            elif uid_max == cursor.uid_end or (cursor.uid_next and cursor.uid_end < cursor.uid_next - 1):
+                # NOTE: the backlog (or a gap of deleted messages) is passed chunk by chunk without waiting
+                move_cursor(cursor, cursor.uid_end + 1)
+                continue
+            elif uid_max:
+                move_cursor(cursor, uid_max + 1)
+
+            await wait_server_push(imap_client)
+            select = True
 
         except asyncio.TimeoutError:
-            logger.exception(f'Timeout exception')
+            logger.exception(f'Timeout exception: {cursor.account} {cursor.folder}')
             raise asyncio.TimeoutError
 
 
-async def connect() -> aioimaplib.IMAP4_SSL:
+async def select_folder(imap_client, cursor: MailboxCursor, states: dict[str, MailboxState]):
+    resp = await imap_client.select(cursor.folder)
+    if resp.result != 'OK':
+        logger.error(f'Select command return an error: {resp}')
+        raise
+
+    uid_validity, uid_next, permanent_flags = parse_select_response(resp.lines)
+    if cursor.uid_validity is None:
+        state = states.get(cursor.folder)
+        if state and state.uid_validity == uid_validity:
+            logger.info(f'Resume mail folder: {cursor.folder} last_uid={state.last_uid}')
+            move_cursor(cursor, state.last_uid + 1)
+        elif state:
+            logger.warning(f'UIDVALIDITY of {cursor.folder} is changed: {state.uid_validity} -> {uid_validity}, rescan it')
+            move_cursor(cursor, 1)
+        else:
+            # NOTE: proof jobs and approvals stored before the folder state have no UIDVALIDITY
+            await crud.set_missing_uid_validity(cursor.account, cursor.folder, uid_validity)
+    elif cursor.uid_validity != uid_validity:
+        logger.warning(f'UIDVALIDITY of {cursor.folder} is changed: {cursor.uid_validity} -> {uid_validity}, rescan it')
+        move_cursor(cursor, 1)
+
+    cursor.uid_validity = uid_validity
+    cursor.uid_next = uid_next
+    # NOTE: \* allows new keywords, otherwise messages are deduplicated by DB only
+    keyword = conf.IMAP_PROCESSED_KEYWORD.encode()
+    cursor.keywords = conf.IMAP_KEYWORDS_ENABLED and (b'\\*' in permanent_flags or keyword in permanent_flags)
+    if conf.IMAP_KEYWORDS_ENABLED and not cursor.keywords:
+        logger.warning(f'Mail folder {cursor.folder} does not allow the keyword: {conf.IMAP_PROCESSED_KEYWORD}')
+
+
+def parse_select_response(lines: list) -> tuple[int, int | None, list[bytes]]:
+    uid_validity, uid_next, permanent_flags = None, None, []
+    for line in lines:
+        if match := SELECT_UIDVALIDITY.search(line):
+            uid_validity = int(match.group('uid_validity'))
+        if match := SELECT_UIDNEXT.search(line):
+            uid_next = int(match.group('uid_next'))
+        if match := SELECT_PERMANENTFLAGS.search(line):
+            permanent_flags = match.group('flags').split()
+
+    if uid_validity is None:
+        # NOTE: RFC 3501 requires UIDVALIDITY in the SELECT response
+        logger.error(f'UIDVALIDITY is not found: {lines}')
+        raise
+    return uid_validity, uid_next, permanent_flags
+
+
+def move_cursor(cursor: MailboxCursor, uid_start: int):
+    cursor.uid_start = uid_start
+    cursor.uid_end = uid_start + CHUNK_SIZE - 1
+
+
+async def connect(account: str) -> aioimaplib.IMAP4_SSL:
     imap_client = aioimaplib.IMAP4_SSL(host=conf.IMAP_HOST, port=conf.IMAP_PORT)
     resp = await imap_client.wait_hello_from_server()
     logger.info(f'Hello server: {resp}')
 
-    await authenticate_oauth_token(imap_client)
+    await authenticate_oauth_token(imap_client, account)
 
     return imap_client
 
 
-async def authenticate_oauth_token(imap_client):
-    token = await fetch_access_token(conf.GMAIL_REFRESH_TOKEN, conf.GMAIL_CLIENT_ID, conf.GMAIL_CLIENT_SECRET)
-    resp = await imap_client.xoauth2(conf.RELAYER_EMAIL, token)
+async def authenticate_oauth_token(imap_client, account: str):
+    token = await fetch_access_token(ACCOUNTS[account], conf.GMAIL_CLIENT_ID, conf.GMAIL_CLIENT_SECRET)
+    resp = await imap_client.xoauth2(account, token)
     logger.info(f'Auth: {resp}')
 
 
@@ -93,17 +212,70 @@ async def fetch_access_token(refresh_token: str, client_id: str, client_secret:
             return data['access_token']
 
 
-async def fetch_imap_messages(imap_client, uid_start: int, uid_end: int) -> int:
-    resp = await imap_client.uid(FETCH_COMMAND, f'{uid_start}:{uid_end}', FETCH_CRITERIA_PARTS)
-    logger.info(f'Fetch mails UIDs={uid_start}:{uid_end} (lines={len(resp.lines)} / 3)')
-
+async def fetch_imap_messages(imap_client, cursor: MailboxCursor, check_uid: bool = True) -> tuple[int, int | None]:
+    """Returns the max UID processed before the first failed message and the UID of that message."""
+    uid_set = f'{cursor.uid_start}:{cursor.uid_end}'
+    if cursor.keywords:
+        # NOTE: processed messages are never downloaded again
+        uids = await search_unprocessed(imap_client, uid_set)
+        if not uids:
+            logger.info(f'No unprocessed messages UIDs={uid_set}')
+            return 0, None
+        uid_set = ','.join(str(uid) for uid in uids)
+
+    # NOTE: headers first, so spam and mail of non-members are never downloaded in full
+    headers = await fetch_uid_range(imap_client, uid_set, FETCH_HEADERS_PARTS)
+
+    candidates = await filter_candidates(headers)
+    logger.info(f'Fetched headers UIDs={uid_set} (messages={len(headers)} candidates={len(candidates)})')
+
+    if candidates:
+        # NOTE: the DKIM keys are resolved while the full messages are downloaded
+        prefetch_task = asyncio.create_task(
+            dkim_keys.prefetch(get_message_key_name(raw_headers) for _, raw_headers in candidates)
+        )
+        messages = await fetch_uid_range(
+            imap_client, ','.join(str(uid) for uid, _ in candidates), FETCH_CRITERIA_PARTS,
+        )
+        await prefetch_task
+        failed_uids = await process_imap_messages(cursor, messages, check_uid)
+    else:
+        failed_uids = set()
+
+    # NOTE: skipped and rejected messages are marked too, so their headers are not fetched again
+    processed_uids = [uid for uid, _ in headers if uid not in failed_uids]
+    if cursor.keywords and processed_uids:
+        # NOTE: failed messages stay unmarked and are retried by the next pass
+        await mark_processed(imap_client, processed_uids)
+
+    uid_failed = min(failed_uids, default=None)
+    uid_max = max((uid for uid in processed_uids if uid_failed is None or uid < uid_failed), default=0)
+    logger.info(f'Fetched uid_max={uid_max} uid_failed={uid_failed}')
+    return uid_max, uid_failed
+
+
+async def search_unprocessed(imap_client, uid_set: str) -> list[int]:
+    resp = await imap_client.uid_search(f'UID {uid_set} UNKEYWORD {conf.IMAP_PROCESSED_KEYWORD}', charset=None)
     if resp.result != 'OK':
-        logger.error(f'Fetch command return an error: {resp}')
+        logger.error(f'Search command return an error: {resp}')
         raise
+    return parse_search_lines(resp.lines)
+
+
+def parse_search_lines(lines: list) -> list[int]:
+    # NOTE: the last line is the command status
+    return sorted(int(uid) for line in lines[:-1] for uid in line.split() if uid.isdigit())
+
+
+async def mark_processed(imap_client, uids: list[int]):
+    uid_set = ','.join(str(uid) for uid in uids)
+    resp = await imap_client.uid('store', uid_set, '+FLAGS.SILENT', f'({conf.IMAP_PROCESSED_KEYWORD})')
+    if resp.result != 'OK':
+        # NOTE: not marked messages are fetched again and deduplicated by DB
+        logger.error(f'Store command return an error: {resp}')
 
-    uid_max = await process_imap_messages(resp.lines)
-    logger.info(f'Fetched uid_max={uid_max}')
 
+async def wait_server_push(imap_client):
     idle = await imap_client.idle_start(timeout=conf.IMAP_IDLE_TIMEOUT)
     logger.info(f'IDLE: {idle.get_name()}')
 
@@ -114,46 +286,83 @@ async def fetch_imap_messages(imap_client, uid_start: int, uid_end: int) -> int:
 
     await asyncio.wait_for(idle, 30)
 
-    return uid_max
 
+async def fetch_uid_range(imap_client, uid_set: str, parts: str) -> list[tuple[int, bytes]]:
+    resp = await imap_client.uid(FETCH_COMMAND, uid_set, parts)
+    logger.info(f'Fetch {parts} UIDs={uid_set} (lines={len(resp.lines)} / 3)')
 
-async def process_imap_messages(lines: list) -> int:
-    uid_max = 0
+    if resp.result != 'OK':
+        logger.error(f'Fetch command return an error: {resp}')
+        raise
+
+    return split_fetch_lines(resp.lines)
 
+
+def split_fetch_lines(lines: list) -> list[tuple[int, bytes]]:
     lines = lines[:-1]
     if rem := len(lines) % 3:
         logger.warning(f'Excess lines detected. All lines: {lines}')
         lines = lines[:len(lines) - rem]
 
-    for start, raw_msg, end in batched(lines, 3):
+    messages = []
+    for start, literal, end in batched(lines, 3):
         fetch_command_without_literal = b'%s %s' % (start, end)
         uid: int = int(FETCH_MESSAGE_DATA_UID.match(fetch_command_without_literal).group('uid'))
         # flags=FETCH_MESSAGE_DATA_FLAGS.match(fetch_command_without_literal).group('flags'),
         # sequence_number: int = FETCH_MESSAGE_DATA_SEQNUM.match(fetch_command_without_literal).group('seqnum')
-
-        # # Just print from/to/subject of received emails
-        # msg: Message = BytesParser().parsebytes(raw_msg)
-        # _, member_email = parseaddr(msg['From'])
-        # _, relayer_email = parseaddr(msg['To'])
-        # msg_hash = msg['Subject']
-        # print(f'Raw message is parsed: uid={uid} from={member_email} to={relayer_email} subj={msg_hash}')
-        # if uid > uid_max:
-        #     uid_max = uid
-        # continue
-
-        try:
-            logger.info(f'====== Parse raw message: UID={uid}')
-            member_message = await parse_member_message(uid, raw_msg)
-            if member_message:
-                logger.info(f'Process member message')
-                is_confirmed, txn = await process_member_message(uid, member_message)
-                if txn:
-                    logger.info(f'Send response by member message')
-                    await send_response_by_member_message(member_message, txn, is_confirmed)
-        except:
-            logger.exception('Member message processing is failed')
-
-        if uid > uid_max:
-            uid_max = uid
-
-    return uid_max
+        messages.append((uid, literal))
+    return messages
+
+
+async def filter_candidates(headers: list[tuple[int, bytes]]) -> list[tuple[int, bytes]]:
+    """Messages which could be member messages by From, To, Subject and DKIM-Signature headers."""
+    parsed = []
+    for uid, raw_headers in headers:
+        msg: Message = BytesParser(policy=policy.default).parsebytes(raw_headers, headersonly=True)
+        _, member_email = parseaddr(msg['From'])
+        _, relayer_email = parseaddr(msg['To'])
+        parsed.append((uid, raw_headers, member_email.lower(), relayer_email, msg['Subject'], msg['DKIM-Signature']))
+
+    member_emails = await crud.get_member_emails({member_email for _, _, member_email, _, _, _ in parsed})
+
+    candidates = []
+    for uid, raw_headers, member_email, relayer_email, msg_hash, dkim_signature in parsed:
+        if not is_relayer_email(relayer_email) or member_email not in member_emails:
+            logger.info(f'Message is skipped: uid={uid} from={member_email} to={relayer_email}')
+        elif not is_msg_hash_format(msg_hash) or not dkim_signature:
+            logger.info(f'Message is skipped: uid={uid} subj={msg_hash} dkim={bool(dkim_signature)}')
+        else:
+            candidates.append((uid, raw_headers))
+    return candidates
+
+
+async def process_imap_messages(
+        cursor: MailboxCursor,
+        messages: list[tuple[int, bytes]],
+        check_uid: bool = True,
+) -> set[int]:
+    """Returns UIDs of the messages to retry, which failed by an exception (e.g. DB or DNS errors).
+
+    The rest are enqueued or rejected, a message failed IMAP_MESSAGE_MAX_ATTEMPTS times is skipped.
+    """
+    items = [
+        (MessageUid(cursor.account, cursor.folder, cursor.uid_validity, uid), raw_msg, check_uid)
+        for uid, raw_msg in messages
+    ]
+    # NOTE: the cursor moves after the whole chunk is processed, the chunks of other folders are not waited
+    failed = await INGESTION.process(items, key=lambda item: item[0])
+
+    retried = set()
+    for uid, _, _ in items:
+        if uid not in failed:
+            FAILED_ATTEMPTS.pop(uid, None)
+            continue
+        attempts = FAILED_ATTEMPTS.get(uid, 0) + 1
+        if attempts >= conf.IMAP_MESSAGE_MAX_ATTEMPTS:
+            # NOTE: a message failed the same way every time would block the folder, it is skipped as rejected
+            logger.error(f'Message is failed {attempts} times, it is skipped: {uid}')
+            FAILED_ATTEMPTS.pop(uid, None)
+        else:
+            FAILED_ATTEMPTS[uid] = attempts
+            retried.add(uid.uid)
+    return retried
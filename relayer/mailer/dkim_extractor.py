@@ -1,9 +1,11 @@
 import re
 import base64
+import functools
 import logging
 
 from dkim import DKIM
-from dkim.asyncsupport import get_txt_async
+from dkim import DKIMException
+from dkim import RE_BTAG
 from dkim.asyncsupport import load_pk_from_dns_async
 from dkim import hash_headers
 from dkim import CanonicalizationPolicy
@@ -11,11 +13,95 @@ from dkim import InvalidCanonicalizationPolicyError
 from dkim import MessageFormatError
 from dkim import HASH_ALGORITHMS
 from dkim import HashThrough
+from dkim import rfc822_parse
+from dkim.util import InvalidTagValueList
+from dkim.util import parse_tag_value
+
+import metrics
+from mailer import dkim_keys
+from logger import logger
 
 # logger = logging.getLogger(__name__)
 # logging.basicConfig(level=logging.DEBUG)
 
 
+class SammDKIM(DKIM):
+    """Keeps the signature, key and signed headers of the verification, so the prover data needs no second pass."""
+
+    sig: dict[bytes, bytes] | None = None
+    sig_header: tuple[bytes, bytes] | None = None
+
+    def verify_sig(self, sig, include_headers, sig_header, dnsfunc):
+        self.sig = sig
+        self.sig_header = sig_header
+        return super().verify_sig(sig, include_headers, sig_header, dnsfunc)
+
+    def signed_headers_merged(self) -> bytes:
+        """The exact bytes hashed by the verification (see dkim.hash_headers)."""
+        canon_policy = CanonicalizationPolicy.from_c_value(self.sig.get(b'c', b'simple/simple'))
+        sig_headers = canon_policy.canonicalize_headers([(self.sig_header[0], RE_BTAG.sub(b'\\1', self.sig_header[1]))])
+        # the dkim sig is hashed with no trailing crlf
+        headers = self.signed_headers + [(name, value.rstrip()) for name, value in sig_headers]
+        return b''.join(name + b':' + value for name, value in headers)
+
+
+def get_key_name(sig_value: bytes) -> bytes | None:
+    """DNS name of the DKIM key (selector._domainkey.domain.) from the DKIM-Signature header value."""
+    try:
+        sig = parse_tag_value(sig_value)
+        return sig[b's'] + b"._domainkey." + sig[b'd'] + b"."
+    except (InvalidTagValueList, KeyError):
+        return None
+
+
+def get_message_key_name(raw_email: bytes) -> bytes | None:
+    """DNS name of the key of the first DKIM signature (the verified one), only the message headers are parsed."""
+    # NOTE: IMAP literals are bytearray
+    raw_headers = bytes(re.split(br'\r?\n\r?\n', raw_email, maxsplit=1)[0])
+    try:
+        headers, _ = rfc822_parse(raw_headers)
+    except MessageFormatError:
+        return None
+    for name, value in headers:
+        if name.lower() == b'dkim-signature':
+            return get_key_name(value)
+    return None
+
+
+def verify_dkim(
+        raw_email: bytes,
+        key_txt: bytes | str | None,
+) -> tuple[str, list[int], int, int, list[str], list[str], list[str]] | None:
+    """Verifies the first DKIM signature and returns the same data as extract_dkim_data, None if it is not valid.
+
+    The key TXT record is fetched in advance (see dkim_keys), so the function is sync and runs in message workers.
+    """
+    dkim_obj = SammDKIM(raw_email)
+    try:
+        # NOTE: dkim signatures could be more than 1, but we use only first one
+        if not dkim_obj.verify(idx=0, dnsfunc=lambda name, timeout=5: key_txt):
+            return None
+    except DKIMException as e:
+        logger.warning(f'DKIM verification is failed: {e}')
+        return None
+
+    _, domain, signature = get_dns_params(dkim_obj.sig)
+    key_size, pubkey_modulus_limbs, redc_params_limbs, signature_limbs = \
+        calc_key_limbs(dkim_obj.pk['modulus'], dkim_obj.keysize, signature)
+    headers, headers_length = pad_header(dkim_obj.signed_headers_merged())
+
+    return (
+        domain,
+        headers,
+        headers_length,
+        key_size,
+        pubkey_modulus_limbs,
+        redc_params_limbs,
+        signature_limbs,
+    )
+
+
+@metrics.timed()
 async def extract_dkim_data(raw_email: bytes) -> tuple[str, list[int], int, int, list[str], list[str], list[str]]:
     # dkim_obj = DKIM(raw_email, logger=logger)
     dkim_obj = DKIM(raw_email)
@@ -57,31 +143,46 @@ def get_dns_params(sig: dict[bytes: bytes]) -> tuple[str, str, int]:
 
 async def extract_limbs(dns_name: str, signature: int) -> tuple[int, list[str], list[str], list[str]]:
     # TODO: add try-cache for network exceptions
-    pk, key_size, _, _ = await load_pk_from_dns_async(dns_name, get_txt_async)
+    # NOTE: the lookup is shared with the concurrent DKIM verification of the same message
+    pk, key_size, _, _ = await load_pk_from_dns_async(dns_name, dkim_keys.get_txt)
+    return calc_key_limbs(pk['modulus'], key_size, signature)
 
-    pubkey_modulus_limbs = calc_limbs(pk['modulus'])
+
+def calc_key_limbs(modulus: int, key_size: int, signature: int) -> tuple[int, list[str], list[str], list[str]]:
+    pubkey_modulus_limbs, redc_params_limbs = calc_pubkey_limbs(modulus, key_size)
+    signature_limbs = calc_limbs(signature)
+
+    # NOTE: copies, the cached limbs are shared by all messages signed with the key
+    return key_size, list(pubkey_modulus_limbs), list(redc_params_limbs), signature_limbs
+
+
+@functools.lru_cache(maxsize=dkim_keys.DKIM_KEY_CACHE_SIZE)
+def calc_pubkey_limbs(modulus: int, key_size: int) -> tuple[tuple[str, ...], tuple[str, ...]]:
+    """The limbs depend on the public key only, so they are computed once per key (the modulus is the cache key)."""
+    pubkey_modulus_limbs = tuple(calc_limbs(modulus))
 
     # TODO: (1 << (2 * keysize + 4)?
     # https://docs.rs/noir-bignum-paramgen/latest/src/noir_bignum_paramgen/lib.rs.html#25
-    redc_params_limbs = calc_limbs((1 << (2 * key_size)) // pk['modulus'])
+    redc_params_limbs = tuple(calc_limbs((1 << (2 * key_size)) // modulus))
+
+    return pubkey_modulus_limbs, redc_params_limbs
 
-    signature_limbs = calc_limbs(signature)
 
-    return key_size, pubkey_modulus_limbs, redc_params_limbs, signature_limbs
+LIMB_BITS = 120
+LIMB_MASK = (1 << LIMB_BITS) - 1
 
 
 def calc_limbs(modulus: int) -> list[str]:
+    """120-bit limbs, the least significant first, as even-length hex strings."""
     out = []
-    hhh = bin(modulus)[2:]
-    for i in range(len(hhh), 0, -120):
-        if (i - 120) < 0:
-            val = hex(int(hhh[0:i], 2))
-        else:
-            val = hex(int(hhh[i-120:i], 2))
+    while True:
+        val = hex(modulus & LIMB_MASK)
         if len(val) % 2:
-            val = val.replace('0x', '0x0')
+            val = '0x0' + val[2:]
         out.append(val)
-    return out
+        modulus >>= LIMB_BITS
+        if not modulus:
+            return out
 
 
 def extract_header(
@@ -102,8 +203,10 @@ def extract_header(
     # NOTE: hasher is updated inside the function
     hash_headers(hasher, canon_policy, headers, include_headers, sig_headers, sig)
 
-    signed_headers_merged = hasher.hashed()
+    return pad_header(hasher.hashed())
+
 
+def pad_header(signed_headers_merged: bytes) -> tuple[list[int], int]:
     signed_headers_merged_len = len(signed_headers_merged)
     if (zeroes_num := 1024 - signed_headers_merged_len) > 0:
         signed_headers_merged += b'\x00' * zeroes_num
@@ -0,0 +1,158 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from collections.abc import Iterable
+from dataclasses import dataclass
+
+import aiodns
+
+import metrics
+from logger import logger
+from mailer.dkim_registry import DKIM_KEY_REGISTRY_ENABLED
+from mailer.dkim_registry import DkimKeyRegistry
+
+DKIM_KEY_CACHE_SIZE = int(os.environ.get('DKIM_KEY_CACHE_SIZE') or 1024)
+# seconds, TXT TTLs are clamped to [min, max]
+DKIM_KEY_MIN_TTL = int(os.environ.get('DKIM_KEY_MIN_TTL') or 60)
+DKIM_KEY_MAX_TTL = int(os.environ.get('DKIM_KEY_MAX_TTL') or 24 * 60 * 60)
+# seconds a missing key (NXDOMAIN, no TXT record) is cached
+DKIM_KEY_NEGATIVE_TTL = int(os.environ.get('DKIM_KEY_NEGATIVE_TTL') or 60)
+# seconds after expiration a key is still used if DNS fails (timeout, SERVFAIL)
+DKIM_KEY_STALE_TTL = int(os.environ.get('DKIM_KEY_STALE_TTL') or 24 * 60 * 60)
+
+# NOTE: the record does not exist, a repeated query gives the same answer
+NEGATIVE_DNS_ERRORS = (aiodns.error.ARES_ENOTFOUND, aiodns.error.ARES_ENODATA)
+
+
+class DkimKeyLookupError(Exception):
+    """DNS is failed and no stale key is cached, unlike a missing key the lookup could pass on a retry."""
+
+
+@dataclass
+class _Entry:
+    txt: bytes | str | None
+    expires_at: float
+    stale_until: float
+
+
+class DkimKeyCache:
+    """Process-wide cache of DKIM key TXT records (selector._domainkey.domain), which respects TXT TTLs."""
+
+    def __init__(
+            self,
+            max_size: int = DKIM_KEY_CACHE_SIZE,
+            min_ttl: int = DKIM_KEY_MIN_TTL,
+            max_ttl: int = DKIM_KEY_MAX_TTL,
+            negative_ttl: int = DKIM_KEY_NEGATIVE_TTL,
+            stale_ttl: int = DKIM_KEY_STALE_TTL,
+            registry: DkimKeyRegistry | None = None,
+    ):
+        self.max_size = max_size
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.negative_ttl = negative_ttl
+        self.stale_ttl = stale_ttl
+        self.registry = registry
+
+        # NOTE: the least recently used key is the first one
+        self._entries: OrderedDict[str, _Entry] = OrderedDict()
+        # concurrent lookups of the same name share a single DNS query
+        self._in_flight: dict[str, asyncio.Task] = {}
+        self._resolver: aiodns.DNSResolver | None = None
+
+    async def get_txt(self, name: bytes | str, timeout: float = 5) -> bytes | str | None:
+        """dnsfunc for dkimpy, returns the TXT record or None if the record does not exist."""
+        key = _normalize(name)
+
+        # NOTE: the registry snapshot is served first, DNS is used only for unknown or expired keys
+        if self.registry and (txt := self.registry.get(key)):
+            return txt
+
+        entry = self._entries.get(key)
+        if entry and time.monotonic() < entry.expires_at:
+            self._entries.move_to_end(key)
+            return entry.txt
+
+        task = self._in_flight.get(key)
+        if not task:
+            task = asyncio.create_task(self._resolve(key, timeout))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        # NOTE: a cancelled caller does not cancel the lookup of other callers
+        return await asyncio.shield(task)
+
+    async def prefetch(self, names: Iterable[bytes | str | None]):
+        """Resolves the distinct keys concurrently, so a batch of messages costs a single DNS round-trip."""
+        keys = {_normalize(name) for name in names if name}
+        results = await asyncio.gather(*(self.get_txt(key) for key in keys), return_exceptions=True)
+        for key, result in zip(keys, results):
+            if isinstance(result, Exception):
+                logger.error(f'DKIM key prefetch is failed: {key} {result!r}')
+
+    def clear(self):
+        self._entries.clear()
+
+    async def _resolve(self, key: str, timeout: float) -> bytes | str | None:
+        try:
+            result = await asyncio.wait_for(self._get_resolver().query(key, 'TXT'), timeout)
+        except aiodns.error.DNSError as e:
+            if e.args and e.args[0] in NEGATIVE_DNS_ERRORS:
+                logger.warning(f'DKIM key is not found: {key}')
+                self._store(key, None, self.negative_ttl)
+                return None
+            return self._get_stale(key, e)
+        except asyncio.TimeoutError as e:
+            return self._get_stale(key, e)
+
+        if not result:
+            self._store(key, None, self.negative_ttl)
+            return None
+
+        # NOTE: a DKIM key has a single TXT record
+        ttl = min(max(result[0].ttl, self.min_ttl), self.max_ttl)
+        self._store(key, result[0].text, ttl)
+        if self.registry:
+            self.registry.put(key, result[0].text)
+        return result[0].text
+
+    def _get_stale(self, key: str, error: Exception) -> bytes | str:
+        entry = self._entries.get(key)
+        if entry and entry.txt is not None and time.monotonic() < entry.stale_until:
+            logger.warning(f'DKIM key lookup is failed, the expired key is used: {key} {error!r}')
+            return entry.txt
+        # NOTE: not a missing key, otherwise a valid message would be rejected by a DNS outage
+        raise DkimKeyLookupError(f'DKIM key lookup is failed: {key} {error!r}') from error
+
+    def _store(self, key: str, txt: bytes | str | None, ttl: float):
+        now = time.monotonic()
+        self._entries[key] = _Entry(txt=txt, expires_at=now + ttl, stale_until=now + ttl + self.stale_ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def _get_resolver(self) -> aiodns.DNSResolver:
+        # NOTE: the resolver is bound to the event loop it was created in
+        loop = asyncio.get_running_loop()
+        if self._resolver is None or self._resolver.loop is not loop:
+            self._resolver = aiodns.DNSResolver(loop=loop)
+        return self._resolver
+
+
+def _normalize(name: bytes | str) -> str:
+    if isinstance(name, bytes):
+        name = name.decode()
+    return name.lower().rstrip('.')
+
+
+REGISTRY = DkimKeyRegistry()
+CACHE = DkimKeyCache(registry=REGISTRY if DKIM_KEY_REGISTRY_ENABLED else None)
+
+
+async def get_txt(name: bytes | str, timeout: float = 5) -> bytes | str | None:
+    return await CACHE.get_txt(name, timeout=timeout)
+
+
+@metrics.timed('dkim_prefetch')
+async def prefetch(names: Iterable[bytes | str | None]):
+    await CACHE.prefetch(names)
@@ -0,0 +1,123 @@
+import asyncio
+import json
+import os
+import time
+from dataclasses import asdict
+from dataclasses import dataclass
+
+from dkim import DKIMException
+from dkim import evaluate_pk
+
+from logger import logger
+
+DKIM_KEY_REGISTRY_ENABLED = os.environ.get('DKIM_KEY_REGISTRY_ENABLED', 'true').lower() != 'false'
+# JSON snapshot of DKIM keys of the member domains, see README.md for the format
+DKIM_KEY_REGISTRY_FILE = os.environ.get('DKIM_KEY_REGISTRY_FILE') or 'dkim_keys.json'
+# seconds a key fetched from DNS is served from the registry
+DKIM_KEY_REGISTRY_TTL = int(os.environ.get('DKIM_KEY_REGISTRY_TTL') or 7 * 24 * 60 * 60)
+# seconds between writes of the keys fetched from DNS, the rest is written on shutdown
+DKIM_KEY_REGISTRY_FLUSH_INTERVAL = int(os.environ.get('DKIM_KEY_REGISTRY_FLUSH_INTERVAL') or 60)
+
+REGISTRY_VERSION = 1
+
+
+@dataclass
+class RegistryKey:
+    domain: str
+    selector: str
+    # the DKIM key TXT record, as published in DNS
+    txt: str
+    # hex, informational: the key of the circuit inputs
+    modulus: str | None
+    # unix time, None - the key does not expire
+    valid_until: int | None
+
+    @property
+    def name(self) -> str:
+        return f'{self.selector}._domainkey.{self.domain}'
+
+
+class DkimKeyRegistry:
+    """Local snapshot of DKIM keys, which serves key lookups before DNS and stores the keys fetched from DNS."""
+
+    def __init__(self, filename: str = DKIM_KEY_REGISTRY_FILE, ttl: int = DKIM_KEY_REGISTRY_TTL):
+        self.filename = filename
+        self.ttl = ttl
+        self._keys: dict[str, RegistryKey] = {}
+        # keys were added since the last write
+        self.dirty = False
+
+    def load(self):
+        try:
+            with open(self.filename) as file:
+                data = json.load(file)
+            keys = [RegistryKey(**key) for key in data['keys']]
+        except FileNotFoundError:
+            logger.info(f'DKIM key registry is not found, it is created by DNS lookups: {self.filename}')
+            return
+        except:
+            # NOTE: a broken snapshot must not stop the relayer, the keys are fetched from DNS
+            logger.exception(f'DKIM key registry loading is failed: {self.filename}')
+            return
+
+        self._keys = {key.name.lower(): key for key in keys}
+        logger.info(f'DKIM key registry is loaded: {len(self._keys)} keys')
+
+    def get(self, name: str) -> str | None:
+        """name is normalized: selector._domainkey.domain in lower case without the trailing dot."""
+        key = self._keys.get(name)
+        if not key or (key.valid_until is not None and time.time() >= key.valid_until):
+            return None
+        return key.txt
+
+    def put(self, name: str, txt: bytes | str):
+        if '._domainkey.' not in name:
+            return
+        if isinstance(txt, bytes):
+            txt = txt.decode()
+
+        try:
+            pk, _, ktag, _ = evaluate_pk(name, txt)
+        except DKIMException as e:
+            logger.warning(f'DKIM key is not stored to the registry: {name} {e}')
+            return
+
+        selector, domain = name.split('._domainkey.', 1)
+        self._keys[name] = RegistryKey(
+            domain=domain,
+            selector=selector,
+            txt=txt,
+            modulus=hex(pk['modulus']) if ktag == b'rsa' else None,
+            valid_until=int(time.time()) + self.ttl,
+        )
+        # NOTE: written by flush_periodically, not on every DNS lookup
+        self.dirty = True
+
+    def flush(self):
+        if self.dirty:
+            self.dirty = False
+            self._write(self._dump())
+
+    async def flush_periodically(self, interval: int = DKIM_KEY_REGISTRY_FLUSH_INTERVAL):
+        while True:
+            await asyncio.sleep(interval)
+            if self.dirty:
+                self.dirty = False
+                # NOTE: the snapshot is taken in the event loop, keys can be added while the file is written
+                await asyncio.to_thread(self._write, self._dump())
+
+    def _dump(self) -> dict:
+        return {
+            'version': REGISTRY_VERSION,
+            'keys': [asdict(key) for key in sorted(self._keys.values(), key=lambda key: (key.domain, key.selector))],
+        }
+
+    def _write(self, data: dict):
+        try:
+            # NOTE: atomic replace, so a crash never leaves a partially written snapshot
+            tmp_filename = f'{self.filename}.tmp'
+            with open(tmp_filename, 'w') as file:
+                json.dump(data, file, indent=2)
+            os.replace(tmp_filename, self.filename)
+        except OSError:
+            logger.exception(f'DKIM key registry writing is failed: {self.filename}')
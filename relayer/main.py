@@ -1,27 +1,61 @@
 #!/usr/bin/env python3
 import asyncio
-import time
 
 import conf
 import db
 import crud
 import imap_client
+import metrics
+import proof_jobs
+import prover
+from mailer import dkim_keys
+from models import MailboxCursor
 from logger import logger
 
 
 RECONNECT_DELAY = 30
 
 
-if __name__ == '__main__':
-    loop = asyncio.get_event_loop()
-    if conf.INIT_DATABASE:
-        loop.run_until_complete(db.init_db())
-        # NOTE: remove or refactor the fill_db_initial_txn function before release
-        loop.run_until_complete(crud.fill_db_initial_txn(first_user_email='example@domain.com'))
+async def run_idle_loops():
+    # NOTE: messages are not ingested until the prover is ready
+    await prover.PROVER_READY.wait()
+    await asyncio.gather(*(run_idle_loop(cursor) for cursor in imap_client.CURSORS))
 
+
+async def run_idle_loop(cursor: MailboxCursor):
+    # NOTE: a failed folder reconnects alone, the other folders keep their connections
     while True:
         try:
-            loop.run_until_complete(imap_client.idle_loop())
+            await imap_client.idle_loop(cursor)
         except:
-            logger.exception(f'idle_loop is failed. reconnect after {RECONNECT_DELAY} sec')
-            time.sleep(RECONNECT_DELAY)
+            logger.exception(f'idle_loop of {cursor.account} {cursor.folder} is failed. reconnect after {RECONNECT_DELAY} sec')
+            await asyncio.sleep(RECONNECT_DELAY)
+
+
+async def main():
+    if conf.INIT_DATABASE:
+        await db.init_db()
+        # NOTE: remove or refactor the fill_db_initial_txn function before release
+        await crud.fill_db_initial_txn(first_user_email='example@domain.com')
+    else:
+        await db.upgrade_db()
+
+    dkim_keys.REGISTRY.load()
+
+    # NOTE: IMAP ingestion only enqueues proof jobs, proving is done by the workers
+    await asyncio.gather(
+        prover.run_warm_up(),
+        run_idle_loops(),
+        proof_jobs.run_workers(conf.PROOF_WORKERS),
+        metrics.run(),
+        dkim_keys.REGISTRY.flush_periodically(),
+    )
+
+
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    try:
+        loop.run_until_complete(main())
+    finally:
+        # the keys fetched from DNS since the last periodic write
+        dkim_keys.REGISTRY.flush()
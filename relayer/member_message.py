@@ -1,30 +1,23 @@
 import asyncio
 import re
-from email import policy
-from email.message import Message
-from email.parser import BytesParser
-from email.utils import parseaddr
-
-import dkim
 
 import conf
 import crud
+import message_worker
+from mailer import dkim_keys
 from mailer.dkim_extractor import extract_dkim_data
+from mailer.dkim_extractor import verify_dkim
 from mailer.sender import send_email
-from mailer.body_parser import parse_body
-from models import ApprovalData
 from models import InitialData
 from models import Member
 from models import MemberMessage
+from models import MessageUid
 from models import ProofStruct
 from models import Txn
 from models import TxnOperation
 from models import TxnData
-from utils import convert_str_to_int_list
-from utils import generate_merkle_tree
-from utils import get_padded_domain
-from utils import get_padded_email
-from utils import generate_sequences
+from models import VerifiedMessage
+from pipeline import KeyedLock
 from prover import generate_zk_proof
 from txn_execution import check_threshold
 from txn_execution import execute_txn
@@ -32,79 +25,150 @@ from txn_execution import change_txn_status
 from logger import logger
 
 
-async def parse_member_message(uid: int, raw_msg: bytes) -> MemberMessage | None:
-    # verify DKIM
-    logger.info('Verify DKIM')
-    if not await dkim.verify_async(raw_msg):
-        logger.warning('DKIM is not valid')
-        return None
+# base64 of the 32-byte SAMM message hash, 44 chars as the msg_hash circuit input
+MSG_HASH_FORMAT = re.compile(r'[A-Za-z0-9+/]{43}=')
+
+# serializes storing and threshold checks of the same txn (by msg_hash)
+TXN_LOCKS = KeyedLock()
+
+
+class MessageRejected(Exception):
+    """The member message is not valid, the pending preparation steps are cancelled."""
+
+
+async def parse_member_message(uid: MessageUid, raw_msg: bytes) -> MemberMessage | None:
+    verified = await verify_member_message(uid, raw_msg)
+    return await build_member_message(verified) if verified else None
+
 
+async def verify_member_message(uid: MessageUid, raw_msg: bytes, check_uid: bool = True) -> VerifiedMessage | None:
     # parse email message
     logger.info('Parse raw message')
-    msg: Message = BytesParser(policy=policy.default).parsebytes(raw_msg)
-    _, member_email = parseaddr(msg['From'])
-    _, relayer_email = parseaddr(msg['To'])
-    msg_hash = msg['Subject']
+    parsed = await message_worker.run('parse_message', message_worker.parse_message, raw_msg)
+    member_email = parsed.member_email
+    relayer_email = parsed.relayer_email
+    msg_hash = parsed.msg_hash
     logger.info(f'Raw message is parsed: from={member_email} to={relayer_email} subj={msg_hash}')
 
     logger.info('Check relayer email')
-    if relayer_email.lower() != conf.RELAYER_EMAIL:
+    if not is_relayer_email(relayer_email):
         logger.warning(f'Email "To" does not belong to Relayer: {relayer_email} != {conf.RELAYER_EMAIL}')
         return None
 
     logger.info('Check msg_hash')
-    # # TODO: check msgHash format
-    # pattern = re.compile(r'\b[0-9a-fA-F]{64}\b')
-    # match = re.match(pattern, 'hash')
-    # print(match.group(0))  # hash
-    if not msg_hash:
+    if not is_msg_hash_format(msg_hash):
         logger.warning(f'msgHash format is not correct: {msg_hash}')
         return None
 
-    logger.info('Check member by "From" email')
-    member = await crud.get_member_by_email(member_email.lower())
-    if not member:
-        logger.warning(f'Email "From" is not a member: {member_email}')
+    # NOTE: independent steps run concurrently, the first rejection cancels the others
+    member_task = asyncio.create_task(_get_member(member_email))
+    try:
+        dkim_data, _, member, (txn, members, initial_data) = await _gather_or_cancel(
+            asyncio.create_task(_verify_dkim(raw_msg, parsed.dkim_key_name)),
+            asyncio.create_task(_check_uid(uid, check_uid)),
+            member_task,
+            asyncio.create_task(_get_txn_and_members(parsed.body, msg_hash, member_task)),
+        )
+    except MessageRejected as e:
+        logger.warning(f'Member message is rejected: {e}')
         return None
 
-    # TODO: optimize via IMAP server flags
-    logger.info('Check already processed message UID')
-    if await crud.get_approval_by_uid(email_uid=uid):
-        logger.error(f'The email UID already was registered: {uid}')
-        return None
+    return VerifiedMessage(
+        uid=uid,
+        msg_hash=msg_hash,
+        relayer_email=relayer_email,
+        member=member,
+        members=members,
+        txn=txn,
+        initial_data=initial_data,
+        dkim_data=dkim_data,
+    )
 
-    txn = await crud.get_txn_by_msg_hash(msg_hash)
-    if txn:
-        logger.info('Transaction approval')
-        members, initial_data = (await _process_approval_message(txn.id, member.id)),  None
-    else:
-        logger.info('Transaction initialization')
-        members, initial_data = await _process_initial_message(msg, msg_hash)
 
-    if not members:
-        return None
+def is_relayer_email(email: str) -> bool:
+    return email.lower() == conf.RELAYER_EMAIL or email.lower() in conf.IMAP_EXTRA_ACCOUNTS
+
 
+def is_msg_hash_format(msg_hash: str | None) -> bool:
+    return bool(msg_hash) and MSG_HASH_FORMAT.fullmatch(msg_hash) is not None
+
+
+async def build_member_message(verified: VerifiedMessage) -> MemberMessage:
     logger.info('Assemble approval data')
-    approval_data = await create_approval_data(raw_msg, msg_hash, members, member, relayer_email)
+    approval_data = await create_approval_data(
+        None, verified.msg_hash, verified.members, verified.member, verified.relayer_email,
+        dkim_data=verified.dkim_data,
+    )
     return MemberMessage(
-        member=member,
-        txn=txn,
-        initial_data=initial_data,
+        member=verified.member,
+        txn=verified.txn,
+        initial_data=verified.initial_data,
         approval_data=approval_data,
     )
 
 
-async def _process_initial_message(msg, msg_hash) -> tuple[list[Member], InitialData | None]:
-    body = parse_body(msg)
-    samm_id, txn_data = extract_txn_data(body)
+async def _gather_or_cancel(*tasks: asyncio.Task) -> list:
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+
+
+async def _verify_dkim(raw_msg: bytes, key_name: bytes | None) -> tuple:
+    # NOTE: the prover data is taken from the verification itself, no second parsing, hashing and key lookup
+    logger.info('Verify DKIM')
+    if not key_name:
+        raise MessageRejected('No DKIM signature')
+    # NOTE: the key is fetched in the event loop, because the DNS cache is per process
+    key_txt = await dkim_keys.get_txt(key_name)
+    dkim_data = await message_worker.run('dkim_verify', verify_dkim, raw_msg, key_txt)
+    if not dkim_data:
+        raise MessageRejected('DKIM is not valid')
+    return dkim_data
+
+
+async def _check_uid(uid: MessageUid, check_uid: bool):
+    if not check_uid:
+        # NOTE: the message is not marked by the IMAP keyword, so it was not processed (see imap_client)
+        return
+    logger.info('Check already processed message UID')
+    if any(await asyncio.gather(crud.get_proof_job_by_uid(uid), crud.get_approval_by_uid(uid))):
+        raise MessageRejected(f'The email UID already was registered: {uid}')
+
+
+async def _get_member(member_email: str) -> Member:
+    logger.info('Check member by "From" email')
+    member = await crud.get_member_by_email(member_email.lower())
+    if not member:
+        raise MessageRejected(f'Email "From" is not a member: {member_email}')
+    return member
+
+
+async def _get_txn_and_members(
+        body: str | None,
+        msg_hash: str,
+        member_task: asyncio.Task,
+) -> tuple[Txn | None, list[Member], InitialData | None]:
+    txn = await crud.get_txn_by_msg_hash(msg_hash)
+    if txn:
+        logger.info('Transaction approval')
+        return txn, await _process_approval_message(txn.id, member_task), None
+
+    logger.info('Transaction initialization')
+    members, initial_data = await _process_initial_message(body, msg_hash)
+    return None, members, initial_data
+
+
+async def _process_initial_message(body: str | None, msg_hash: str) -> tuple[list[Member], InitialData]:
+    samm_id, txn_data = extract_txn_data(body or '')
     if not samm_id or not txn_data:
-        logger.error(f'Wrong initial data: body={body}')
-        return [], None
+        raise MessageRejected(f'Wrong initial data: body={body}')
 
     members = await crud.get_members_by_samm(samm_id)
     if not members:
-        logger.error(f'No members for samm_id: {samm_id}')
-        return [], None
+        raise MessageRejected(f'No members for samm_id: {samm_id}')
 
     initial_data = InitialData(
         samm_id=samm_id,
@@ -115,13 +179,11 @@ async def _process_initial_message(msg, msg_hash) -> tuple[list[Member], Initial
     return members, initial_data
 
 
-async def _process_approval_message(txn_id: int, member_id: int) -> list[Member]:
+async def _process_approval_message(txn_id: int, member_task: asyncio.Task) -> list[Member]:
     # TODO: check txn_status or deadline if approval
-    if await crud.get_approval_by_txn_and_email(txn_id=txn_id, member_id=member_id):
-        logger.error(f'Dublicate approval: tx={txn_id} member={member_id}')
-        return []
-
-    members = await crud.get_members_by_txn(txn_id)
+    members, member = await asyncio.gather(crud.get_members_by_txn(txn_id), member_task)
+    if await crud.get_approval_by_txn_and_email(txn_id=txn_id, member_id=member.id):
+        raise MessageRejected(f'Dublicate approval: tx={txn_id} member={member.id}')
     return members
 
 
@@ -156,77 +218,58 @@ def extract_txn_data(body: str) -> tuple[int, TxnData] | tuple[None, None]:
     # TODO: validate txn_data fields
 
 
-def calculate_samm_root(members: list[Member]):
+async def create_approval_data(
+        raw_msg: bytes,
+        msg_hash_b64: str,
+        members: list[Member],
+        member: Member,
+        relayer_email: str,
+        dkim_data: tuple | None = None,
+):
+    # NOTE: dkim_data could be extracted in advance, see parse_member_message
+    dkim_data = dkim_data or await extract_dkim_data(raw_msg)
+
     # TODO: less predictable order
     members.sort(key=lambda x: x.id)
-    emails_and_secrets = [(member.email, int(member.secret)) for member in members]
-    tree = generate_merkle_tree(emails_and_secrets)
-    return str(tree.root), tree
-
-
-async def create_approval_data(raw_msg: bytes, msg_hash_b64: str, members: list[Member], member: Member, relayer_email: str):
-    domain, header, header_length, key_size, pubkey_modulus_limbs, redc_params_limbs, signature_limbs = \
-        await extract_dkim_data(raw_msg)
-    msg_hash = convert_str_to_int_list(msg_hash_b64)
-    padded_domain, padded_domain_length = get_padded_domain(domain)
-    padded_member, padded_member_length = get_padded_email(member.email)
-    padded_relayer, padded_relayer_length = get_padded_email(relayer_email)
-
-    root, tree = calculate_samm_root(members)
-    path_elements, path_indices = tree.gen_proof(leaf_pos=members.index(member))
-
-    # calculate sequences
-    from_seq, member_seq, to_seq, relayer_seq = generate_sequences(header, header_length, member.email, relayer_email)
-
-    return ApprovalData(
-        domain=domain,
-        header=header,
-        header_length=header_length,
-
-        msg_hash=msg_hash,
-
-        padded_member=padded_member,
-        padded_member_length=padded_member_length,
-        secret=member.secret,
-        relayer_address=str(conf.RELAYER_ADDRESS),
-        padded_relayer=padded_relayer,
-        padded_relayer_length=padded_relayer_length,
-
-        padded_domain=padded_domain,
-        padded_domain_length=padded_domain_length,
-        key_size=key_size,
-        pubkey_modulus_limbs=pubkey_modulus_limbs,
-        redc_params_limbs=redc_params_limbs,
-        signature=signature_limbs,
-
-        root=root,
-        path_elements=[str(i) for i in path_elements],
-        path_indices=path_indices,
-
-        from_seq=from_seq,
-        member_seq=member_seq,
-        to_seq=to_seq,
-        relayer_seq=relayer_seq,
+    return await message_worker.run(
+        'create_approval_data',
+        message_worker.build_approval_data,
+        dkim_data,
+        msg_hash_b64,
+        [(m.email, m.secret) for m in members],
+        members.index(member),
+        relayer_email,
+        str(conf.RELAYER_ADDRESS),
     )
 
 
-async def process_member_message(uid: int, member_message) -> tuple[bool, Txn | None]:
-    proof_struct = await generate_zk_proof(member_message.approval_data)
-    if not proof_struct:
+async def process_member_message(uid: MessageUid, member_message) -> tuple[bool, Txn | None]:
+    proved = await generate_zk_proof(member_message.approval_data)
+    if not proved:
         # TODO: send response that we could not generate proof
         return False, None
+    proof_struct, is_verified = proved
 
-    txn = await store_member_message(uid, member_message, proof_struct)
+    # NOTE: proofs of the same txn are generated concurrently, but stored and counted one by one,
+    # otherwise two last approvals could both reach the threshold and execute the txn twice
+    msg_hash = member_message.txn.msg_hash if member_message.txn else member_message.initial_data.msg_hash
+    async with TXN_LOCKS.lock(msg_hash):
+        txn = await store_member_message(uid, member_message, proof_struct, is_verified)
 
-    is_confirmed, proof_structs = await check_threshold(txn)
-    if is_confirmed:
-        txn_status = await execute_txn(txn, proof_structs)
-        txn = await change_txn_status(txn, txn_status)
+        is_confirmed, proof_structs = await check_threshold(txn)
+        if is_confirmed:
+            txn_status = await execute_txn(txn, proof_structs)
+            txn = await change_txn_status(txn, txn_status)
 
     return is_confirmed, txn
 
 
-async def store_member_message(uid: int, msg: MemberMessage, proof_struct: ProofStruct) -> Txn:
+async def store_member_message(
+        uid: MessageUid,
+        msg: MemberMessage,
+        proof_struct: ProofStruct,
+        is_verified: bool = False,
+) -> Txn:
     # TODO: commit new txn and approval in the same session
     logger.info(f'Store member message info')
 
@@ -235,12 +278,16 @@ async def store_member_message(uid: int, msg: MemberMessage, proof_struct: Proof
         logger.error('Collision of initial data and txn')
         raise
 
-    if msg.initial_data:
+    if msg.initial_data and (txn := await crud.get_txn_by_msg_hash(msg.initial_data.msg_hash)):
+        # NOTE: several members could initialize the same txn concurrently, the first stored one wins
+        logger.info(f'Transaction was initialized by another message: {msg.initial_data.msg_hash}')
+    elif msg.initial_data:
         await crud.create_txn(msg.initial_data)
         txn = await crud.get_txn_by_msg_hash(msg.initial_data.msg_hash)
         logger.info('New txn is stored')
 
-    await crud.create_approval(txn, msg.member, proof_struct, uid)
+    # NOTE: generate_zk_proof rejects invalid proofs, is_verified is False if bb did not verify the proof
+    await crud.create_approval(txn, msg.member, proof_struct, uid, is_verified=is_verified)
     logger.info('New approval is stored')
     return txn
 
@@ -0,0 +1,137 @@
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
+from email import policy
+from email.message import Message
+from email.parser import BytesParser
+from email.utils import parseaddr
+
+import conf
+import metrics
+from mailer.body_parser import parse_body
+from mailer.dkim_extractor import get_message_key_name
+from models import ApprovalData
+from utils import convert_str_to_int_list
+from utils import generate_merkle_tree
+from utils import get_padded_domain
+from utils import get_padded_email
+from utils import generate_sequences
+from logger import logger
+
+_POOL: ProcessPoolExecutor | None = None
+
+
+@dataclass
+class ParsedMessage:
+    member_email: str
+    relayer_email: str
+    msg_hash: str | None
+    body: str | None
+    # DNS name of the DKIM key, fetched by the event loop before the verification
+    dkim_key_name: bytes | None
+
+
+async def run(stage: str, func, *args):
+    """Runs a CPU-bound function in the message worker processes, so the event loop keeps serving IMAP and DB.
+
+    The function and its arguments and result must be picklable. MESSAGE_WORKERS=0 runs it in the event loop.
+    """
+    global _POOL
+
+    with metrics.timer(stage):
+        if not conf.MESSAGE_WORKERS:
+            return func(*args)
+
+        if _POOL is None:
+            _POOL = ProcessPoolExecutor(max_workers=conf.MESSAGE_WORKERS)
+        try:
+            return await asyncio.get_running_loop().run_in_executor(_POOL, func, *args)
+        except BrokenProcessPool:
+            # NOTE: a killed worker breaks the whole pool, it is recreated on the next call
+            logger.error('Message worker pool is broken, restart it')
+            _POOL.shutdown(wait=False, cancel_futures=True)
+            _POOL = None
+            raise
+
+
+def shutdown():
+    global _POOL
+    if _POOL is not None:
+        _POOL.shutdown(wait=False, cancel_futures=True)
+        _POOL = None
+
+
+def parse_message(raw_msg: bytes) -> ParsedMessage:
+    msg: Message = BytesParser(policy=policy.default).parsebytes(raw_msg)
+    _, member_email = parseaddr(msg['From'])
+    _, relayer_email = parseaddr(msg['To'])
+
+    try:
+        body = parse_body(msg)
+    except:
+        logger.exception('Message body parsing is failed')
+        body = None
+
+    return ParsedMessage(
+        member_email=member_email,
+        relayer_email=relayer_email,
+        msg_hash=msg['Subject'],
+        body=body,
+        dkim_key_name=get_message_key_name(raw_msg),
+    )
+
+
+def build_approval_data(
+        dkim_data: tuple,
+        msg_hash_b64: str,
+        emails_and_secrets: list[tuple[str, str]],
+        member_idx: int,
+        relayer_email: str,
+        relayer_address: str,
+) -> ApprovalData:
+    """emails_and_secrets are ordered as the SAMM members tree leaves, member_idx is the sender leaf."""
+    domain, header, header_length, key_size, pubkey_modulus_limbs, redc_params_limbs, signature_limbs = dkim_data
+    member_email, member_secret = emails_and_secrets[member_idx]
+
+    msg_hash = convert_str_to_int_list(msg_hash_b64)
+    padded_domain, padded_domain_length = get_padded_domain(domain)
+    padded_member, padded_member_length = get_padded_email(member_email)
+    padded_relayer, padded_relayer_length = get_padded_email(relayer_email)
+
+    tree = generate_merkle_tree([(email, int(secret)) for email, secret in emails_and_secrets])
+    path_elements, path_indices = tree.gen_proof(leaf_pos=member_idx)
+
+    # calculate sequences
+    from_seq, member_seq, to_seq, relayer_seq = generate_sequences(header, header_length, member_email, relayer_email)
+
+    return ApprovalData(
+        domain=domain,
+        header=header,
+        header_length=header_length,
+
+        msg_hash=msg_hash,
+
+        padded_member=padded_member,
+        padded_member_length=padded_member_length,
+        secret=member_secret,
+        relayer_address=relayer_address,
+        padded_relayer=padded_relayer,
+        padded_relayer_length=padded_relayer_length,
+
+        padded_domain=padded_domain,
+        padded_domain_length=padded_domain_length,
+        key_size=key_size,
+        pubkey_modulus_limbs=pubkey_modulus_limbs,
+        redc_params_limbs=redc_params_limbs,
+        signature=signature_limbs,
+
+        root=str(tree.root),
+        path_elements=[str(i) for i in path_elements],
+        path_indices=path_indices,
+
+        from_seq=from_seq,
+        member_seq=member_seq,
+        to_seq=to_seq,
+        relayer_seq=relayer_seq,
+    )
@@ -0,0 +1,151 @@
+import asyncio
+import functools
+import inspect
+import os
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+import conf
+from logger import logger
+
+# seconds, from DB queries to 2048-bit proofs
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+STAGE_DURATION_METRIC = 'relayer_stage_duration_seconds'
+STAGE_ERRORS_METRIC = 'relayer_stage_errors_total'
+
+
+class Histogram:
+    def __init__(self, buckets: tuple[float, ...] = BUCKETS):
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        for idx, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.bucket_counts[idx] += 1
+
+
+STAGE_DURATIONS: dict[str, Histogram] = defaultdict(Histogram)
+STAGE_ERRORS: dict[str, int] = defaultdict(int)
+
+
+def observe(stage: str, seconds: float):
+    STAGE_DURATIONS[stage].observe(seconds)
+
+
+@contextmanager
+def timer(stage: str):
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        # NOTE: asyncio.CancelledError is not an error of the stage, e.g. siblings cancelled by _gather_or_cancel
+        STAGE_ERRORS[stage] += 1
+        raise
+    finally:
+        observe(stage, time.perf_counter() - start)
+
+
+def timed(stage: str | None = None):
+    """Decorator for sync and async functions, the stage is the function name by default."""
+    def decorator(func):
+        name = stage or func.__name__
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with timer(name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(name):
+                return func(*args, **kwargs)
+        return wrapper
+
+    return decorator
+
+
+def render() -> str:
+    """Metrics in the Prometheus text exposition format."""
+    lines = [
+        f'# HELP {STAGE_DURATION_METRIC} Duration of relayer pipeline stages.',
+        f'# TYPE {STAGE_DURATION_METRIC} histogram',
+    ]
+    for stage, histogram in sorted(STAGE_DURATIONS.items()):
+        # NOTE: prometheus buckets are cumulative, observe() already counts each value in every upper bucket
+        for bound, bucket_count in zip(histogram.buckets, histogram.bucket_counts):
+            lines.append(f'{STAGE_DURATION_METRIC}_bucket{{stage="{stage}",le="{bound}"}} {bucket_count}')
+        lines.append(f'{STAGE_DURATION_METRIC}_bucket{{stage="{stage}",le="+Inf"}} {histogram.count}')
+        lines.append(f'{STAGE_DURATION_METRIC}_sum{{stage="{stage}"}} {histogram.sum}')
+        lines.append(f'{STAGE_DURATION_METRIC}_count{{stage="{stage}"}} {histogram.count}')
+
+    lines += [
+        f'# HELP {STAGE_ERRORS_METRIC} Number of relayer pipeline stages failed with an exception.',
+        f'# TYPE {STAGE_ERRORS_METRIC} counter',
+    ]
+    for stage, errors in sorted(STAGE_ERRORS.items()):
+        lines.append(f'{STAGE_ERRORS_METRIC}{{stage="{stage}"}} {errors}')
+
+    return '\n'.join(lines) + '\n'
+
+
+async def _handle_http(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request_line = await reader.readline()
+        # skip request headers
+        while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+            pass
+
+        if request_line.split(b' ')[:2] == [b'GET', b'/metrics']:
+            status, body = '200 OK', render().encode()
+        else:
+            status, body = '404 Not Found', b'not found\n'
+
+        writer.write(
+            f'HTTP/1.1 {status}\r\n'
+            f'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+            f'Content-Length: {len(body)}\r\n'
+            f'Connection: close\r\n\r\n'.encode() + body
+        )
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(host: str, port: int):
+    server = await asyncio.start_server(_handle_http, host, port)
+    logger.info(f'Metrics are served on http://{host}:{port}/metrics')
+    async with server:
+        await server.serve_forever()
+
+
+async def dump_periodically(filename: str, interval: int):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            # NOTE: atomic replace, so readers never see a partially written file
+            tmp_filename = f'{filename}.tmp'
+            with open(tmp_filename, 'w') as file:
+                file.write(render())
+            os.replace(tmp_filename, filename)
+        except OSError:
+            logger.exception(f'Metrics dump is failed: {filename}')
+
+
+async def run():
+    tasks = []
+    if conf.METRICS_PORT:
+        tasks.append(serve(conf.METRICS_HOST, conf.METRICS_PORT))
+    if conf.METRICS_FILE:
+        tasks.append(dump_periodically(conf.METRICS_FILE, conf.METRICS_DUMP_INTERVAL))
+    await asyncio.gather(*tasks)
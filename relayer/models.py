@@ -5,8 +5,10 @@ from enum import Enum
 from sqlmodel import Field, SQLModel, Column
 from pydantic import EmailStr
 from sqlalchemy import BigInteger
+from sqlalchemy import JSON
 from sqlalchemy import String
 from sqlalchemy import Enum as sa_Enum
+from sqlalchemy import false
 from sqlmodel import Relationship
 
 
@@ -23,6 +25,13 @@ class TxnStatus(str, Enum):
     failed = 'failed'
 
 
+class ProofJobStatus(str, Enum):
+    pending = 'pending'
+    processing = 'processing'
+    done = 'done'
+    failed = 'failed'
+
+
 @dataclass
 class Sequence:
     index: int
@@ -117,15 +126,95 @@ class Approval(SQLModel, table=True):
     is_2048_sig: bool
     created_at: datetime
     email_uid: int
+    # NOTE: email_uid identifies the message only with the mailbox folder and its UIDVALIDITY, see MessageUid
+    account: str | None = None
+    folder: str | None = None
+    uid_validity: int | None = Field(default=None, sa_column=Column(BigInteger()))
+    # NOTE: the proof was verified locally by bb before storing
+    is_verified: bool = Field(default=False, sa_column_kwargs={'server_default': false()})
 
     member: Member = Relationship(back_populates='approvals')
 
 
+class ProofJob(SQLModel, table=True):
+    __tablename__ = 'proof_jobs'
+
+    id: int | None = Field(default=None, nullable=False, primary_key=True)
+    email_uid: int = Field(index=True)
+    # NOTE: email_uid identifies the message only with the mailbox folder and its UIDVALIDITY, see MessageUid
+    account: str | None = None
+    folder: str | None = None
+    uid_validity: int | None = Field(default=None, sa_column=Column(BigInteger()))
+    member_id: int = Field(foreign_key='member.id')
+    msg_hash: str
+    # NOTE: serialized InitialData and ApprovalData, see proof_jobs.py
+    initial_data: dict | None = Field(default=None, sa_column=Column(JSON))
+    approval_data: dict = Field(sa_column=Column(JSON))
+    status: ProofJobStatus = Field(sa_column=Column(sa_Enum(ProofJobStatus)))
+    attempts: int = Field(default=0)
+    error: str | None = None
+    created_at: datetime
+    updated_at: datetime
+
+
+class MailboxState(SQLModel, table=True):
+    """The sync state of a mailbox folder, the IMAP ingestion resumes from it after a restart."""
+    __tablename__ = 'mailbox_states'
+
+    account: str = Field(primary_key=True)
+    folder: str = Field(primary_key=True)
+    # NOTE: UIDs are valid only with the same UIDVALIDITY of the folder (RFC 3501 2.3.1.1)
+    uid_validity: int = Field(sa_column=Column(BigInteger(), nullable=False))
+    # all messages up to the UID are processed
+    last_uid: int = Field(sa_column=Column(BigInteger(), nullable=False))
+    updated_at: datetime
+
+
+class DataMigration(SQLModel, table=True):
+    __tablename__ = 'data_migrations'
+
+    name: str = Field(primary_key=True)
+    applied_at: datetime
+
+
+@dataclass
+class ProofJobCandidate:
+    job_id: int
+    created_at: datetime
+    # NOTE: txn fields are taken from initial data if the txn is not stored yet
+    txn_status: TxnStatus | None = None
+    deadline: int | None = None
+    threshold: int | None = None
+    approvals: int = 0
+    # pending jobs for the same msg_hash, including this one
+    pending_jobs: int = 1
+
+
 @dataclass
 class MailboxCursor:
+    # the relayer mailbox email
+    account: str
     folder: str
     uid_start: int
     uid_end: int
+    # None - the folder is not selected yet
+    uid_validity: int | None = None
+    # UIDNEXT of the last SELECT
+    uid_next: int | None = None
+    # the folder allows to mark processed messages by conf.IMAP_PROCESSED_KEYWORD
+    keywords: bool = False
+
+
+@dataclass(frozen=True)
+class MessageUid:
+    """An IMAP UID is unique only in its mailbox folder with the same UIDVALIDITY (RFC 3501 2.3.1.1)."""
+    account: str
+    folder: str
+    uid_validity: int
+    uid: int
+
+    def __str__(self) -> str:
+        return f'{self.account} {self.folder} {self.uid_validity}:{self.uid}'
 
 
 @dataclass
@@ -193,3 +282,16 @@ class MemberMessage:
     txn: Txn | None
     initial_data: InitialData | None
     approval_data: ApprovalData
+
+
+@dataclass
+class VerifiedMessage:
+    """A member message which passed the checks, but its approval data is not assembled yet."""
+    uid: MessageUid
+    msg_hash: str
+    relayer_email: str
+    member: Member
+    members: list[Member]
+    txn: Txn | None
+    initial_data: InitialData | None
+    dkim_data: tuple
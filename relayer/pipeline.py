@@ -0,0 +1,127 @@
+import asyncio
+from collections.abc import Awaitable
+from collections.abc import Callable
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import Any
+
+import metrics
+from logger import logger
+
+
+@dataclass
+class Stage:
+    name: str
+    # returns the item of the next stage, None drops the item
+    handler: Callable[[Any], Awaitable[Any]]
+    workers: int
+    queue: asyncio.Queue | None = None
+
+
+class Batch:
+    """Items put together, it is done when all of them passed or were dropped by the pipeline."""
+
+    def __init__(self, size: int):
+        self.pending = size
+        # keys of the items failed by an exception, unlike the dropped ones they could pass on a retry
+        self.failed: set[Any] = set()
+        self.done = asyncio.Event()
+        if not size:
+            self.done.set()
+
+    def item_done(self):
+        self.pending -= 1
+        if not self.pending:
+            self.done.set()
+
+
+class Pipeline:
+    """Stages joined by bounded queues, each stage is served by its own workers.
+
+    A full queue blocks the previous stage (backpressure), so a burst of items does not pile up in memory.
+    Items of a stage are processed concurrently, the order is kept only by the handlers which need it.
+    """
+
+    def __init__(self, name: str, stages: list[Stage], queue_size: int):
+        self.name = name
+        self.stages = stages
+        for stage in stages:
+            stage.queue = asyncio.Queue(maxsize=queue_size)
+        self._tasks: list[asyncio.Task] = []
+
+    def start(self):
+        if self._tasks:
+            return
+        for idx, stage in enumerate(self.stages):
+            next_stage = self.stages[idx + 1] if idx + 1 < len(self.stages) else None
+            for _ in range(stage.workers):
+                self._tasks.append(asyncio.create_task(self._work(stage, next_stage)))
+        logger.info(f'Pipeline {self.name} is started: ' + ', '.join(f'{s.name}={s.workers}' for s in self.stages))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def put(self, item: Any, batch: Batch | None = None, key: Any = None):
+        self.start()
+        await self.stages[0].queue.put((batch, key, item))
+
+    async def process(self, items: list[Any], key: Callable[[Any], Any] = lambda item: item) -> set[Any]:
+        """Puts the items and waits until they passed the last stage, the items of other producers are not waited.
+
+        Returns the keys of the failed items, the rest passed or were rejected by a stage.
+        """
+        batch = Batch(len(items))
+        for item in items:
+            # NOTE: blocks while the pipeline is full
+            await self.put(item, batch, key(item))
+        await batch.done.wait()
+        return batch.failed
+
+    async def join(self):
+        """Waits until all put items passed the last stage."""
+        # NOTE: an item is put to the next queue before it is marked as done in the previous one
+        for stage in self.stages:
+            await stage.queue.join()
+
+    async def _work(self, stage: Stage, next_stage: Stage | None):
+        while True:
+            batch, key, item = await stage.queue.get()
+            passed = False
+            try:
+                with metrics.timer(f'{self.name}.{stage.name}'):
+                    result = await stage.handler(item)
+                if result is not None and next_stage:
+                    await next_stage.queue.put((batch, key, result))
+                    passed = True
+            except Exception:
+                logger.exception(f'Pipeline {self.name} stage {stage.name} is failed: {key}')
+                if batch:
+                    batch.failed.add(key)
+            finally:
+                if batch and not passed:
+                    batch.item_done()
+                stage.queue.task_done()
+
+
+class KeyedLock:
+    """Locks by key (e.g. txn msg_hash), the locks of released keys are dropped."""
+
+    def __init__(self):
+        self._locks: dict[Any, asyncio.Lock] = {}
+        self._waiters: dict[Any, int] = {}
+
+    @asynccontextmanager
+    async def lock(self, key: Any):
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        self._waiters[key] = self._waiters.get(key, 0) + 1
+        try:
+            async with lock:
+                yield
+        finally:
+            self._waiters[key] -= 1
+            if not self._waiters[key]:
+                del self._waiters[key]
+                del self._locks[key]
@@ -0,0 +1,101 @@
+import hashlib
+import json
+import os
+import time
+
+import conf
+from logger import logger
+
+PROOF_SUFFIX = '.proof'
+# NOTE: proofs verified by bb are stored separately, so the verification result survives the cache
+VERIFIED_SUFFIX = '.verified' + PROOF_SUFFIX
+
+
+def make_key(circuit_sha256: str, prover_data: dict) -> str:
+    """The same circuit and prover input always give the same proof outputs, so they address the proof."""
+    canonical = json.dumps(
+        {'circuit': circuit_sha256, 'input': prover_data},
+        sort_keys=True,
+        separators=(',', ':'),
+    )
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def get(key: str) -> tuple[bytes, bool] | None:
+    """Returns the proof and whether it was verified."""
+    if not conf.PROOF_CACHE_ENABLED:
+        return None
+
+    for is_verified in (True, False):
+        bb_proof = _read(key, _filename(key, is_verified))
+        if bb_proof is not None:
+            return bb_proof, is_verified
+    return None
+
+
+def put(key: str, bb_proof: bytes, is_verified: bool = False):
+    if not conf.PROOF_CACHE_ENABLED:
+        return
+
+    filename = _filename(key, is_verified)
+    try:
+        os.makedirs(conf.PROOF_CACHE_DIR, exist_ok=True)
+        # NOTE: atomic replace, so a crash never leaves a partially written proof
+        tmp_filename = f'{filename}.tmp'
+        with open(tmp_filename, 'wb') as file:
+            file.write(bb_proof)
+        os.replace(tmp_filename, filename)
+        evict()
+    except OSError:
+        logger.exception(f'Proof cache writing is failed: {key}')
+
+
+def evict():
+    """Removes expired proofs, then the least recently used ones until the cache fits the max size."""
+    now = time.time()
+    entries = []
+    with os.scandir(conf.PROOF_CACHE_DIR) as it:
+        for entry in it:
+            if not entry.name.endswith(PROOF_SUFFIX):
+                continue
+            stat = entry.stat()
+            if now - stat.st_mtime > conf.PROOF_CACHE_MAX_AGE:
+                _remove(entry.path)
+            else:
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total_size <= conf.PROOF_CACHE_MAX_SIZE:
+            break
+        _remove(path)
+        total_size -= size
+
+
+def _read(key: str, filename: str) -> bytes | None:
+    try:
+        if time.time() - os.path.getmtime(filename) > conf.PROOF_CACHE_MAX_AGE:
+            os.remove(filename)
+            return None
+        with open(filename, 'rb') as file:
+            bb_proof = file.read()
+        # NOTE: the access time is tracked by mtime, so the size eviction drops the least recently used proofs
+        os.utime(filename)
+    except FileNotFoundError:
+        return None
+    except OSError:
+        logger.exception(f'Proof cache reading is failed: {key}')
+        return None
+
+    return bb_proof
+
+
+def _remove(filename: str):
+    try:
+        os.remove(filename)
+    except FileNotFoundError:
+        pass
+
+
+def _filename(key: str, is_verified: bool = False) -> str:
+    return os.path.join(conf.PROOF_CACHE_DIR, f'{key}{VERIFIED_SUFFIX if is_verified else PROOF_SUFFIX}')
@@ -0,0 +1,204 @@
+import asyncio
+from dataclasses import asdict
+
+import conf
+import crud
+import prover
+from member_message import MessageRejected
+from member_message import process_member_message
+from member_message import send_response_by_member_message
+from models import ApprovalData
+from models import InitialData
+from models import MemberMessage
+from models import MessageUid
+from models import ProofJob
+from models import ProofJobStatus
+from models import Sequence
+from models import Txn
+from models import TxnData
+from models import TxnOperation
+from pipeline import Pipeline
+from pipeline import Stage
+from logger import logger
+
+# set by enqueue, so idle workers do not wait for the next poll
+JOBS_AVAILABLE = asyncio.Event()
+
+
+async def _send_response(item: tuple[MemberMessage, Txn, bool]):
+    member_message, txn, is_confirmed = item
+    logger.info(f'Send response by member message')
+    await send_response_by_member_message(member_message, txn, is_confirmed)
+
+
+# NOTE: proof workers do not wait for SMTP, the responses are sent by own workers
+NOTIFICATIONS = Pipeline(
+    'notify',
+    [Stage('send_response', _send_response, conf.NOTIFY_WORKERS)],
+    queue_size=conf.INGEST_QUEUE_SIZE,
+)
+
+
+async def enqueue(uid: MessageUid, member_message: MemberMessage) -> ProofJob:
+    msg_hash = member_message.txn.msg_hash if member_message.txn else member_message.initial_data.msg_hash
+    job = await crud.create_proof_job(
+        uid=uid,
+        member_id=member_message.member.id,
+        msg_hash=msg_hash,
+        initial_data=dump_initial_data(member_message.initial_data) if member_message.initial_data else None,
+        approval_data=dump_approval_data(member_message.approval_data),
+    )
+    logger.info(f'Proof job is enqueued: id={job.id} uid={uid}')
+    JOBS_AVAILABLE.set()
+    return job
+
+
+async def run_workers(workers_number: int):
+    await prover.PROVER_READY.wait()
+
+    reset_number = await crud.reset_processing_proof_jobs()
+    if reset_number:
+        logger.warning(f'Unfinished proof jobs are returned to the queue: {reset_number}')
+
+    NOTIFICATIONS.start()
+    await asyncio.gather(*(worker_loop(idx) for idx in range(workers_number)))
+
+
+async def worker_loop(worker_idx: int):
+    logger.info(f'Proof worker #{worker_idx} is started')
+    while True:
+        try:
+            job = await crud.claim_proof_job()
+        except:
+            logger.exception('Proof job claiming is failed')
+            job = None
+
+        if not job:
+            await _wait_for_jobs()
+            continue
+
+        logger.info(f'====== Proof worker #{worker_idx} claimed job: id={job.id} uid={job.email_uid}')
+        try:
+            await process_job(job)
+        except:
+            # NOTE: the job stays in processing status, it is returned to the queue on the next start
+            logger.exception(f'Proof job status update is failed: id={job.id}')
+
+
+async def _wait_for_jobs():
+    JOBS_AVAILABLE.clear()
+    try:
+        await asyncio.wait_for(JOBS_AVAILABLE.wait(), conf.PROOF_JOB_POLL_INTERVAL)
+    except asyncio.TimeoutError:
+        pass
+
+
+async def process_job(job: ProofJob):
+    uid = MessageUid(account=job.account, folder=job.folder, uid_validity=job.uid_validity, uid=job.email_uid)
+    try:
+        # NOTE: the relayer could be restarted after the approval was stored, but before the job was finished
+        if await crud.get_approval_by_uid(uid):
+            logger.warning(f'The email UID already has an approval: {uid}')
+            await crud.change_proof_job_status(job.id, ProofJobStatus.done)
+            return
+
+        member_message = await load_member_message(job)
+        if not member_message:
+            await crud.change_proof_job_status(job.id, ProofJobStatus.failed, 'Member message is not valid anymore')
+            return
+
+        is_confirmed, txn = await process_member_message(uid, member_message)
+        if not txn:
+            await crud.change_proof_job_status(job.id, ProofJobStatus.failed, 'Proof is not valid')
+            return
+        await crud.change_proof_job_status(job.id, ProofJobStatus.done)
+    except MessageRejected as e:
+        logger.error(f'Proof job is rejected: id={job.id} {e}')
+        await crud.change_proof_job_status(job.id, ProofJobStatus.failed, str(e))
+        return
+    except Exception as e:
+        logger.exception(f'Proof job processing is failed: id={job.id}')
+        status = ProofJobStatus.pending if job.attempts < conf.PROOF_JOB_MAX_ATTEMPTS else ProofJobStatus.failed
+        await crud.change_proof_job_status(job.id, status, repr(e))
+        return
+
+    await NOTIFICATIONS.put((member_message, txn, is_confirmed))
+
+
+async def load_member_message(job: ProofJob) -> MemberMessage | None:
+    member = await crud.get_member_by_id(job.member_id)
+    if not member:
+        logger.error(f'Member is not found: {job.member_id}')
+        return None
+
+    initial_data = None
+    txn = await crud.get_txn_by_msg_hash(job.msg_hash)
+    if txn:
+        # NOTE: several members could initialize the same txn, the first stored one wins
+        if job.initial_data:
+            logger.info(f'Transaction was initialized by another message: {job.msg_hash}')
+        if await crud.get_approval_by_txn_and_email(txn_id=txn.id, member_id=member.id):
+            logger.error(f'Dublicate approval: tx={txn.id} member={member.id}')
+            return None
+    elif job.initial_data:
+        initial_data = await load_initial_data(job.initial_data)
+    else:
+        logger.error(f'Transaction is not found: {job.msg_hash}')
+        return None
+
+    return MemberMessage(
+        member=member,
+        txn=txn,
+        initial_data=initial_data,
+        approval_data=load_approval_data(job.approval_data),
+    )
+
+
+def dump_initial_data(initial_data: InitialData) -> dict:
+    # NOTE: members are loaded by samm_id, their ids check that the tree root of the approval data is still valid
+    txn_data = asdict(initial_data.txn_data)
+    txn_data['data'] = initial_data.txn_data.data.decode()
+    txn_data['operation'] = initial_data.txn_data.operation.value
+    return {
+        'samm_id': initial_data.samm_id,
+        'msg_hash': initial_data.msg_hash,
+        'txn_data': txn_data,
+        'member_ids': sorted(m.id for m in initial_data.members),
+    }
+
+
+async def load_initial_data(data: dict) -> InitialData:
+    members = list(await crud.get_members_by_samm(data['samm_id']))
+    # NOTE: the same order as in create_approval_data (the tree of message_worker.build_approval_data)
+    members.sort(key=lambda x: x.id)
+    # NOTE: jobs enqueued before member_ids were stored are not checked
+    if 'member_ids' in data and [m.id for m in members] != data['member_ids']:
+        # the proof would not match the root, so bb time is not spent on it
+        raise MessageRejected(f'SAMM members are changed after the message was enqueued: samm_id={data["samm_id"]}')
+
+    txn_data = data['txn_data']
+    return InitialData(
+        samm_id=data['samm_id'],
+        msg_hash=data['msg_hash'],
+        txn_data=TxnData(
+            to=txn_data['to'],
+            value=txn_data['value'],
+            data=txn_data['data'].encode(),
+            operation=TxnOperation(txn_data['operation']),
+            nonce=txn_data['nonce'],
+            deadline=txn_data['deadline'],
+        ),
+        members=members,
+    )
+
+
+def dump_approval_data(approval_data: ApprovalData) -> dict:
+    return asdict(approval_data)
+
+
+def load_approval_data(data: dict) -> ApprovalData:
+    sequences = {
+        name: Sequence(**data[name])
+        for name in ('from_seq', 'member_seq', 'to_seq', 'relayer_seq')
+    }
+    return ApprovalData(**(data | sequences))
@@ -0,0 +1,44 @@
+import conf
+from models import ProofJobCandidate
+from models import TxnStatus
+
+
+def schedule(candidates: list[ProofJobCandidate], now: float) -> tuple[list[ProofJobCandidate], list[tuple[ProofJobCandidate, str]]]:
+    """Returns pending jobs in the order they should be proved and jobs which are not worth proving with the reason."""
+    scheduled, dropped = [], []
+    for candidate in candidates:
+        if reason := obsolete_reason(candidate, now):
+            dropped.append((candidate, reason))
+        else:
+            scheduled.append(candidate)
+
+    scheduled.sort(key=lambda candidate: (job_priority(candidate, now), candidate.job_id))
+    return scheduled, dropped
+
+
+def obsolete_reason(candidate: ProofJobCandidate, now: float) -> str | None:
+    if candidate.txn_status and candidate.txn_status != TxnStatus.pending:
+        # NOTE: the threshold is already reached, one more approval changes nothing
+        return f'Transaction is already {candidate.txn_status.value}'
+    if candidate.deadline is not None and candidate.deadline <= now:
+        return 'Transaction deadline is passed'
+    return None
+
+
+def job_priority(candidate: ProofJobCandidate, now: float) -> float:
+    """Lower is more urgent, measured in seconds.
+
+    Deadline slack (capped by the horizon) plus a weight for every approval which is still missing after this one,
+    minus the time the job is waiting, so no job starves.
+    """
+    slack = conf.PROOF_JOB_DEADLINE_HORIZON
+    if candidate.deadline is not None:
+        slack = min(candidate.deadline - now, slack)
+
+    remaining_approvals = 0
+    if candidate.threshold is not None:
+        # NOTE: pending jobs of the same txn are proved together, so their approvals are counted as coming
+        remaining_approvals = max(candidate.threshold - candidate.approvals - candidate.pending_jobs, 0)
+
+    age = now - candidate.created_at.timestamp()
+    return slack + remaining_approvals * conf.PROOF_JOB_APPROVAL_WEIGHT - age
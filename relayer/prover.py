@@ -1,20 +1,185 @@
 import asyncio
-import json
+import hashlib
 import os
+import tempfile
+from contextlib import contextmanager
+from dataclasses import dataclass
 
+import admission
+import conf
+import metrics
+import proof_cache
+import witness_worker
 from models import ApprovalData
 from models import ProofStruct
+from remote_prover import RemoteProverBackend
 from logger import logger
 
 current_file_path = os.path.dirname(__file__)
-GENERATE_WITNESS_FILENAME = os.path.join(current_file_path, 'scripts/generateWitness.js')
-PROVER_JSON_FILENAME = os.path.join(current_file_path, 'target/prover.json')
-SAMM_1024_JSON_FILENAME = os.path.join(current_file_path, 'target/samm_1024.json')
-SAMM_2048_JSON_FILENAME = os.path.join(current_file_path, 'target/samm_2048.json')
-WITNESS_GZ_FILENAME = os.path.join(current_file_path, 'target/witness.gz')
+TARGET_DIR = os.path.join(current_file_path, 'target')
+SAMM_1024_JSON_FILENAME = os.path.join(TARGET_DIR, 'samm_1024.json')
+SAMM_2048_JSON_FILENAME = os.path.join(TARGET_DIR, 'samm_2048.json')
+# sha256sum of the circuits which are expected to be deployed
+CIRCUITS_MANIFEST_FILENAME = os.path.join(TARGET_DIR, 'circuits.sha256')
+WITNESS_GZ_NAME = 'witness.gz'
+WARM_UP_RETRY_DELAY = 30
+PROOF_NAME = 'proof'
+# bb exit code of a rejected proof, errors of bb itself exit with the same code, but print the error
+BB_VERIFY_FAILED_EXIT_CODE = 1
 
+# NOTE: every bb process is CPU and memory heavy, 2048-bit proofs much more than 1024-bit ones
+ADMISSION = admission.create_admission_controller()
 
-async def generate_zk_proof(approval_data: ApprovalData) -> ProofStruct | None:
+
+@dataclass
+class Circuit:
+    filename: str
+    sha256: str | None = None
+    vk_filename: str | None = None
+
+
+# key - is_2048_sig
+CIRCUITS = {
+    False: Circuit(filename=SAMM_1024_JSON_FILENAME),
+    True: Circuit(filename=SAMM_2048_JSON_FILENAME),
+}
+
+
+class LocalProverBackend:
+    """Generates proofs with witness workers and bb subprocesses of the current process."""
+
+    def __init__(self, capacity: int):
+        # set when circuits are checked, verification keys and CRS are prepared and witness workers are started
+        self.ready = asyncio.Event()
+        self.capacity = capacity
+        # number of running and waiting proofs
+        self.load = 0
+        self._lock = asyncio.Lock()
+
+    async def warm_up(self):
+        async with self._lock:
+            if not self.ready.is_set():
+                await _warm_up()
+                self.ready.set()
+
+    async def prove(self, is_2048_sig: bool, prover_data: dict) -> tuple[bytes, bool] | None:
+        """Returns the bb proof and whether it was verified, or None if the proof is not valid."""
+        # NOTE: no-op if the prover was warmed up on startup
+        await self.warm_up()
+
+        self.load += 1
+        try:
+            async with ADMISSION.admit(is_2048_sig):
+                witness = await _generate_witness_gz(is_2048_sig, prover_data)
+                bb_proof = await _generate_proof(is_2048_sig, witness)
+
+                # NOTE: an invalid proof is rejected here, not by the contract when the threshold is reached
+                is_verified = False
+                if conf.PROVER_VERIFY_PROOFS:
+                    if not await _verify_proof(is_2048_sig, bb_proof):
+                        return None
+                    is_verified = True
+        finally:
+            self.load -= 1
+
+        return bb_proof, is_verified
+
+
+LOCAL_BACKEND = LocalProverBackend(conf.PROVER_CONCURRENCY)
+# NOTE: the remote backend sends prover data to prover nodes (prover_node.py), which use the local backend
+BACKEND = RemoteProverBackend(conf.PROVER_NODES) if conf.PROVER_BACKEND == 'remote' else LOCAL_BACKEND
+PROVER_READY = BACKEND.ready
+
+
+async def warm_up():
+    await BACKEND.warm_up()
+
+
+async def run_warm_up(backend: LocalProverBackend | RemoteProverBackend = BACKEND):
+    """Retries the warm-up of a long-running service (e.g. witness workers failed to start) until it is ready."""
+    while True:
+        try:
+            await backend.warm_up()
+            return
+        except:
+            logger.exception(f'Prover warm-up is failed. retry after {WARM_UP_RETRY_DELAY} sec')
+            await asyncio.sleep(WARM_UP_RETRY_DELAY)
+
+
+async def _warm_up():
+    logger.info('Prover warm-up started')
+    manifest = _read_circuits_manifest()
+
+    for circuit in CIRCUITS.values():
+        circuit.sha256 = _file_sha256(circuit.filename)
+        name = os.path.basename(circuit.filename)
+        if manifest.get(name) != circuit.sha256:
+            raise ValueError(f'Circuit hash mismatch: {name} sha256={circuit.sha256} expected={manifest.get(name)}')
+
+        # NOTE: the verification key depends on the circuit only, so it is computed once per circuit version
+        vk_filename = os.path.join(TARGET_DIR, f'{name.removesuffix(".json")}.{circuit.sha256[:16]}.vk')
+        if not os.path.exists(vk_filename):
+            # the first bb run also downloads the CRS (~/.bb-crs)
+            await _write_vk(circuit.filename, vk_filename)
+        circuit.vk_filename = vk_filename
+        logger.info(f'Circuit is prepared: {name} vk={vk_filename}')
+
+    await witness_worker.POOL.start()
+    logger.info('Prover warm-up is finished ✅')
+
+
+def _read_circuits_manifest() -> dict[str, str]:
+    manifest = {}
+    with open(CIRCUITS_MANIFEST_FILENAME) as file:
+        for line in file:
+            if line.strip():
+                sha256, name = line.split()
+                manifest[name] = sha256
+    return manifest
+
+
+def _circuit_sha256(is_2048_sig: bool) -> str:
+    circuit = CIRCUITS[is_2048_sig]
+    # NOTE: the remote backend does not warm up local circuits
+    if not circuit.sha256:
+        circuit.sha256 = _file_sha256(circuit.filename)
+    return circuit.sha256
+
+
+def _file_sha256(filename: str) -> str:
+    with open(filename, 'rb') as file:
+        return hashlib.file_digest(file, 'sha256').hexdigest()
+
+
+async def _write_vk(circuit_filename: str, vk_filename: str):
+    logger.info(f'Writing verification key... ⌛ {vk_filename}')
+    # bb write_vk_ultra_keccak_honk -b ./target/samm_2048.json -o ./target/samm_2048.<hash>.vk
+    tmp_vk_filename = f'{vk_filename}.tmp'
+    process = await asyncio.create_subprocess_exec(
+        'bb',
+        'write_vk_ultra_keccak_honk',
+        '-b',
+        circuit_filename,
+        '-o',
+        tmp_vk_filename,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    (stdout, stderr) = await process.communicate()
+    if process.returncode != 0:
+        logger.error(f'Verification key writing is failed ⭕: {stderr}')
+        raise RuntimeError(f'bb write_vk_ultra_keccak_honk exit code: {process.returncode}')
+
+    # NOTE: the key appears only when it is completely written
+    os.replace(tmp_vk_filename, vk_filename)
+
+
+@metrics.timed()
+async def generate_zk_proof(approval_data: ApprovalData) -> tuple[ProofStruct, bool] | None:
+    """
+    Returns the proof and whether bb verified it, or None if the approval data is not provable.
+    Other failures are raised to retry the proof job.
+    """
     logger.info('Proof generation started')
 
     match approval_data.key_size:
@@ -27,28 +192,47 @@ async def generate_zk_proof(approval_data: ApprovalData) -> ProofStruct | None:
             return None
 
     try:
-        _write_prover_json(approval_data)
-        await _generate_witness_gz(is_2048_sig)
-        commit, pubkey_hash, proof = await _generate_proof(is_2048_sig)
+        prover_data = _build_prover_data(approval_data)
+        # NOTE: the relayer could be restarted after the proof generation, but before the approval was stored
+        cache_key = proof_cache.make_key(_circuit_sha256(is_2048_sig), prover_data)
+        cached = proof_cache.get(cache_key)
+        if cached:
+            bb_proof, is_verified = cached
+            logger.info(f'Proof is found in the cache: {cache_key} is_verified={is_verified}')
+        else:
+            proved = await BACKEND.prove(is_2048_sig, prover_data)
+            if not proved:
+                return None
+            bb_proof, is_verified = proved
+            proof_cache.put(cache_key, bb_proof, is_verified)
+
+        commit, pubkey_hash, proof = _split_proof(bb_proof)
+    except witness_worker.WitnessGenerationError:
+        # NOTE: the circuit rejects the prover data, a retry gives the same result
+        logger.exception('Witness is not generated')
+        return None
     except:
+        # NOTE: bb, witness worker and prover node failures, the proof job is returned to the queue
         logger.exception('Proof generation is failed')
-        return None
+        raise
 
     if not commit or not pubkey_hash or not proof:
         logger.exception(f'Proof is wrong: commit={commit} pubkey_hash={pubkey_hash} proof={proof}')
         return None
 
-    logger.info(f'Proof is generated: commit={commit}')
-    return ProofStruct(
-        proof=proof.encode(),
+    logger.info(f'Proof is generated: commit={commit} is_verified={is_verified}')
+    proof_struct = ProofStruct(
+        proof=proof,
         commit=int(commit, 16),
         domain=approval_data.domain,
         pubkeyHash=int(pubkey_hash, 16).to_bytes(length=32),
         is2048sig=is_2048_sig,
     )
+    return proof_struct, is_verified
 
 
-def _write_prover_json(approval_data: ApprovalData):
+@metrics.timed()
+def _build_prover_data(approval_data: ApprovalData) -> dict:
     prover_data = {
         "root": approval_data.root,
         "path_elements": approval_data.path_elements,
@@ -68,65 +252,118 @@ def _write_prover_json(approval_data: ApprovalData):
         "relayer_seq": {"index": approval_data.relayer_seq.index, "length": approval_data.relayer_seq.length}
     }
     logger.info(f'Prover data: {prover_data}')
+    return prover_data
 
-    # Serializing json
-    json_object = json.dumps(prover_data, indent=4)
-
-    # write to prover file
-    with open(PROVER_JSON_FILENAME, 'w+') as file:
-        file.write(json_object)
 
-
-async def _generate_witness_gz(is_2048_sig: bool):
-    # node scripts/generateWitness.js
+@metrics.timed()
+async def _generate_witness_gz(is_2048_sig: bool, prover_data: dict) -> bytes:
+    # the witness is generated by a long-lived node worker (scripts/witnessWorker.js)
     logger.info('Generating witness... ⌛')
-    process = await asyncio.create_subprocess_exec(
-        'node',
-        GENERATE_WITNESS_FILENAME,
-        str(is_2048_sig),
-        stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.PIPE,
-    )
-    logger.info(f'subprocess: {process}')
-    (stdout, stderr) = await process.communicate()
-    if stderr:
-        logger.error(f'Witness generation is failed ⭕: {stderr}')
+    try:
+        witness = await witness_worker.generate_witness(prover_data, is_2048_sig)
+    except:
+        logger.exception('Witness generation is failed ⭕')
         raise
 
-    logger.info(f'Witness is generated ✅: {stdout}')
+    logger.info(f'Witness is generated ✅: {len(witness)} bytes')
+    return witness
 
 
-async def _generate_proof(is_2048_sig: bool) -> tuple[str, str, str]:
+@contextmanager
+def _bb_input_file(data: bytes, name: str):
+    """Yields a path to the bb input file and fds which must be passed to the bb process."""
+    if conf.PROVER_WITNESS_MEMFD:
+        # NOTE: in-memory file, the data never touches the filesystem
+        fd = os.memfd_create(f'samm-{name}')
+        try:
+            _write_all(fd, data)
+            yield f'/dev/fd/{fd}', (fd,)
+        finally:
+            os.close(fd)
+    else:
+        # NOTE: each job gets its own scratch directory, so proofs do not share bb files
+        with tempfile.TemporaryDirectory(prefix='samm-proof-', dir=conf.PROVER_WORKDIR) as workdir:
+            filename = os.path.join(workdir, name)
+            with open(filename, 'wb') as file:
+                file.write(data)
+            yield filename, ()
+
+
+def _write_all(fd: int, data: bytes):
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+@metrics.timed()
+async def _generate_proof(is_2048_sig: bool, witness: bytes) -> bytes:
     logger.info('Generating proof... ⌛')
-    # bb prove_ultra_keccak_honk -b ./target/samm_2048.json -w ./target/witness.gz -o -
-    process = await asyncio.create_subprocess_exec(
-        'bb',
-        'prove_ultra_keccak_honk',
-        '-b',
-        SAMM_2048_JSON_FILENAME if is_2048_sig else SAMM_1024_JSON_FILENAME,
-        '-w',
-        WITNESS_GZ_FILENAME,
-        '-o',
-        '-',
-        stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.PIPE,
-    )
-    logger.info(f'subprocess: {process}')
-    (stdout, stderr) = await process.communicate()
+    # bb prove_ultra_keccak_honk -b ./target/samm_2048.json -w /dev/fd/N -o -
+    with _bb_input_file(witness, WITNESS_GZ_NAME) as (witness_filename, pass_fds):
+        process = await asyncio.create_subprocess_exec(
+            'bb',
+            'prove_ultra_keccak_honk',
+            '-b',
+            CIRCUITS[is_2048_sig].filename,
+            '-w',
+            witness_filename,
+            '-o',
+            '-',
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            pass_fds=pass_fds,
+        )
+        logger.info(f'subprocess: {process}')
+        (stdout, stderr) = await process.communicate()
     if stderr:
         logger.error(f'Proof generation is failed ⭕: {stderr}')
         raise
 
     logger.info('Proof is generated ✅')
+    return stdout
+
+
+@metrics.timed()
+async def _verify_proof(is_2048_sig: bool, bb_proof: bytes) -> bool:
+    logger.info('Verifying proof... ⌛')
+    # bb verify_ultra_keccak_honk -k ./target/samm_2048.<hash>.vk -p /dev/fd/N
+    with _bb_input_file(bb_proof, PROOF_NAME) as (proof_filename, pass_fds):
+        process = await asyncio.create_subprocess_exec(
+            'bb',
+            'verify_ultra_keccak_honk',
+            '-k',
+            CIRCUITS[is_2048_sig].vk_filename,
+            '-p',
+            proof_filename,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            pass_fds=pass_fds,
+        )
+        (stdout, stderr) = await process.communicate()
+
+    if process.returncode == 0:
+        logger.info('Proof is valid ✅')
+        return True
+
+    # NOTE: a missing vk, a failed CRS download, a crash or an OOM kill do not tell anything about the proof,
+    # so they are raised to retry the proof job instead of rejecting the message
+    if process.returncode == BB_VERIFY_FAILED_EXIT_CODE and not stderr.strip():
+        logger.error('Proof is not valid ⭕')
+        return False
+
+    logger.error(f'Proof verification is failed ⭕: exit code {process.returncode} {stderr}')
+    raise RuntimeError(f'bb verify_ultra_keccak_honk exit code: {process.returncode}')
+
 
+def _split_proof(bb_proof: bytes) -> tuple[str, str, bytes]:
     # https://github.com/oxor-io/samm-circuits?tab=readme-ov-file#prepare-proof-for-smart-contract-tests
     # split to public inputs, outputs (commit, pubkeyHash) and proof itself
     # first output
     shift = 4
-    commit = stdout[(shift+6368):((shift+6368) + 32)].hex()
+    commit = bb_proof[(shift+6368):((shift+6368) + 32)].hex()
     # second output
-    pubkey_hash = stdout[(shift+6368+32):((shift+6368+32) + 32)].hex()
+    pubkey_hash = bb_proof[(shift+6368+32):((shift+6368+32) + 32)].hex()
     # proof
-    proof = stdout[shift:shift+96].hex() + stdout[shift+6432:].hex()
+    proof = bb_proof[shift:shift+96] + bb_proof[shift+6432:]
 
     return commit, pubkey_hash, proof
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""Standalone prover node, generates proofs for relayers with PROVER_BACKEND=remote.
+
+POST /prove   {"is_2048_sig": bool, "prover_data": {...}}
+              200 - bb proof, "X-Proof-Verified: true" if bb verified it, 204 - the proof is not valid,
+              422 - the proof is not generated (could pass on a retry)
+GET  /status  {"ready": bool, "load": int, "capacity": int}
+
+Requests are authorized by "Authorization: Bearer PROVER_NODE_TOKEN", the token is required unless the node listens
+on a loopback address or a unix socket.
+"""
+import asyncio
+import hmac
+import ipaddress
+import json
+import os
+
+import conf
+import metrics
+import prover
+import witness_worker
+from logger import logger
+
+# prover data of a single proof is far below it
+MAX_REQUEST_SIZE = 1024 * 1024
+TEXT = {'Content-Type': 'text/plain'}
+
+
+async def handle_http(backend: prover.LocalProverBackend, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request_line = await reader.readline()
+        headers = {}
+        while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+            name, _, value = line.decode().partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        # NOTE: the body is not read for unauthorized and oversized requests
+        content_length = int(headers.get('content-length', 0))
+        if not is_authorized(headers):
+            status, response_headers, payload = '401 Unauthorized', TEXT, b'unauthorized\n'
+        elif not 0 <= content_length <= MAX_REQUEST_SIZE:
+            status, response_headers, payload = '413 Content Too Large', TEXT, b'request is too large\n'
+        else:
+            body = await reader.readexactly(content_length)
+            method, path = request_line.decode().split(' ')[:2]
+            status, response_headers, payload = await handle_request(backend, method, path, body)
+
+        header_lines = ''.join(f'{name}: {value}\r\n' for name, value in response_headers.items())
+        writer.write(
+            f'HTTP/1.1 {status}\r\n'
+            f'{header_lines}'
+            f'Content-Length: {len(payload)}\r\n'
+            f'X-Prover-Load: {backend.load}\r\n'
+            f'X-Prover-Capacity: {backend.capacity}\r\n'
+            f'Connection: close\r\n\r\n'.encode() + payload
+        )
+        await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+        logger.warning('Prover node request is broken')
+    finally:
+        writer.close()
+
+
+def is_authorized(headers: dict) -> bool:
+    if not conf.PROVER_NODE_TOKEN:
+        # NOTE: only local clients could connect, see check_access
+        return True
+    return hmac.compare_digest(headers.get('authorization', ''), f'Bearer {conf.PROVER_NODE_TOKEN}')
+
+
+def check_access(host: str, socket_path: str | None, token: str | None):
+    """Prover data contains member secrets, so a node reachable from the network must require the token."""
+    if socket_path or token:
+        return
+    try:
+        is_loopback = host == 'localhost' or ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        is_loopback = False
+    if not is_loopback:
+        raise ValueError(f'PROVER_NODE_TOKEN is required for the prover node on a non-loopback host: {host}')
+
+
+async def handle_request(
+        backend: prover.LocalProverBackend,
+        method: str,
+        path: str,
+        body: bytes,
+) -> tuple[str, dict, bytes]:
+    match method, path:
+        case 'GET', '/status':
+            node_status = {'ready': backend.ready.is_set(), 'load': backend.load, 'capacity': backend.capacity}
+            return '200 OK', {'Content-Type': 'application/json'}, json.dumps(node_status).encode()
+        case 'POST', '/prove':
+            if not backend.ready.is_set():
+                return '503 Service Unavailable', TEXT, b'prover is not ready\n'
+
+            try:
+                request = json.loads(body)
+                proved = await backend.prove(request['is_2048_sig'], request['prover_data'])
+            except witness_worker.WitnessGenerationError:
+                logger.exception('Witness is not generated')
+                proved = None
+            except Exception as e:
+                logger.exception('Proof generation is failed')
+                return '422 Unprocessable Entity', TEXT, repr(e).encode()
+
+            if not proved:
+                return '204 No Content', TEXT, b''
+            bb_proof, is_verified = proved
+            headers = {'Content-Type': 'application/octet-stream', 'X-Proof-Verified': str(is_verified).lower()}
+            return '200 OK', headers, bb_proof
+        case _:
+            return '404 Not Found', TEXT, b'not found\n'
+
+
+async def serve(backend: prover.LocalProverBackend):
+    check_access(conf.PROVER_NODE_HOST, conf.PROVER_NODE_SOCKET, conf.PROVER_NODE_TOKEN)
+    handler = lambda reader, writer: handle_http(backend, reader, writer)
+    if conf.PROVER_NODE_SOCKET:
+        if os.path.exists(conf.PROVER_NODE_SOCKET):
+            os.remove(conf.PROVER_NODE_SOCKET)
+        server = await asyncio.start_unix_server(handler, conf.PROVER_NODE_SOCKET)
+        logger.info(f'Prover node is served on unix://{conf.PROVER_NODE_SOCKET}')
+    else:
+        server = await asyncio.start_server(handler, conf.PROVER_NODE_HOST, conf.PROVER_NODE_PORT)
+        logger.info(f'Prover node is served on http://{conf.PROVER_NODE_HOST}:{conf.PROVER_NODE_PORT}')
+
+    async with server:
+        await server.serve_forever()
+
+
+async def main():
+    # NOTE: /status reports "ready": false until the warm-up is finished, so relayers skip the node
+    await asyncio.gather(
+        prover.run_warm_up(prover.LOCAL_BACKEND),
+        serve(prover.LOCAL_BACKEND),
+        metrics.run(),
+    )
+
+
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main())
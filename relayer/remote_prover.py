@@ -0,0 +1,183 @@
+import asyncio
+import json
+import random
+from urllib.parse import urlsplit
+
+import conf
+import metrics
+from logger import logger
+
+UNIX_SCHEME = 'unix'
+
+
+class ProverNodeError(Exception):
+    """The prover node is alive, but the proof is not generated."""
+
+
+class ProverUnavailableError(Exception):
+    """No prover node could take the proof request."""
+
+
+class ProverNode:
+    """HTTP client of a prover node (prover_node.py) over TCP or a unix socket."""
+
+    def __init__(self, url: str):
+        self.url = url
+        parsed = urlsplit(url)
+        if parsed.scheme == UNIX_SCHEME:
+            self.socket_path = parsed.path
+            self.host, self.port = 'localhost', None
+        else:
+            self.socket_path = None
+            self.host, self.port = parsed.hostname, parsed.port or 80
+
+        self.is_ready = False
+        self.capacity = 1
+        # running and waiting proofs reported by the node, including other relayers' proofs
+        self.load = 0
+        # proofs sent by this relayer and not finished yet
+        self.in_flight = 0
+
+    @property
+    def score(self) -> float:
+        # NOTE: the reported load could be outdated, so the own requests are counted too
+        return max(self.load, self.in_flight) / self.capacity
+
+    async def refresh_status(self):
+        try:
+            status, _, payload = await self._request('GET', '/status', timeout=conf.PROVER_NODE_STATUS_INTERVAL)
+            if status != 200:
+                raise ProverNodeError(f'status code {status}')
+            node_status = json.loads(payload)
+        except Exception as e:
+            if self.is_ready:
+                logger.warning(f'Prover node is not available: {self.url} {e!r}')
+            self.is_ready = False
+            return
+
+        if node_status['ready'] and not self.is_ready:
+            logger.info(f'Prover node is ready: {self.url}')
+        self.is_ready = node_status['ready']
+        self.capacity = max(node_status['capacity'], 1)
+        self.load = node_status['load']
+
+    async def prove(self, is_2048_sig: bool, prover_data: dict) -> tuple[bytes, bool] | None:
+        body = json.dumps({'is_2048_sig': is_2048_sig, 'prover_data': prover_data}).encode()
+
+        self.in_flight += 1
+        try:
+            status, headers, payload = await self._request('POST', '/prove', body, timeout=conf.PROVER_NODE_TIMEOUT)
+        finally:
+            self.in_flight -= 1
+
+        if 'x-prover-load' in headers:
+            self.load = int(headers['x-prover-load'])
+
+        match status:
+            case 200:
+                return payload, headers.get('x-proof-verified') == 'true'
+            case 204:
+                # the proof is not valid
+                return None
+            case 422:
+                raise ProverNodeError(payload.decode(errors='replace'))
+            case _:
+                raise ConnectionError(f'Unexpected status code {status}: {payload[:200]}')
+
+    async def _request(self, method: str, path: str, body: bytes = b'', timeout: float | None = None) -> tuple[int, dict, bytes]:
+        return await asyncio.wait_for(self._send_request(method, path, body), timeout)
+
+    async def _send_request(self, method: str, path: str, body: bytes) -> tuple[int, dict, bytes]:
+        if self.socket_path:
+            reader, writer = await asyncio.open_unix_connection(self.socket_path)
+        else:
+            reader, writer = await asyncio.open_connection(self.host, self.port)
+
+        try:
+            auth = f'Authorization: Bearer {conf.PROVER_NODE_TOKEN}\r\n' if conf.PROVER_NODE_TOKEN else ''
+            writer.write(
+                f'{method} {path} HTTP/1.1\r\n'
+                f'Host: {self.host}\r\n'
+                f'{auth}'
+                f'Content-Type: application/json\r\n'
+                f'Content-Length: {len(body)}\r\n'
+                f'Connection: close\r\n\r\n'.encode() + body
+            )
+            await writer.drain()
+
+            status_line = await reader.readline()
+            if not status_line:
+                raise ConnectionError('Connection is closed by the prover node')
+            status = int(status_line.split()[1])
+
+            headers = {}
+            while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+                name, _, value = line.decode().partition(':')
+                headers[name.strip().lower()] = value.strip()
+
+            payload = await reader.readexactly(int(headers.get('content-length', 0)))
+        finally:
+            writer.close()
+
+        return status, headers, payload
+
+
+class RemoteProverBackend:
+    """Dispatches proofs to the least loaded prover node."""
+
+    def __init__(self, urls: list[str]):
+        self.ready = asyncio.Event()
+        self.nodes = [ProverNode(url) for url in urls]
+        self._lock = asyncio.Lock()
+        self._status_task: asyncio.Task | None = None
+
+    async def warm_up(self):
+        async with self._lock:
+            if self.ready.is_set():
+                return
+            if not self.nodes:
+                raise ValueError('PROVER_NODES is not set for the remote prover backend')
+
+            logger.info(f'Waiting for prover nodes: {[node.url for node in self.nodes]}')
+            while not await self._refresh_nodes():
+                await asyncio.sleep(conf.PROVER_NODE_STATUS_INTERVAL)
+
+            self._status_task = asyncio.create_task(self._refresh_periodically())
+            self.ready.set()
+            logger.info('Prover nodes are ready ✅')
+
+    async def prove(self, is_2048_sig: bool, prover_data: dict) -> tuple[bytes, bool] | None:
+        await self.warm_up()
+
+        # NOTE: every node is tried once, a failed node is excluded until the next successful status request
+        tried = set()
+        while node := self._pick_node(tried):
+            tried.add(node.url)
+            logger.info(f'Send proof request to prover node: {node.url} load={node.load} in_flight={node.in_flight}')
+            try:
+                with metrics.timer('prover_node.prove'):
+                    return await node.prove(is_2048_sig, prover_data)
+            except ProverNodeError:
+                raise
+            except Exception as e:
+                logger.warning(f'Prover node is failed: {node.url} {e!r}')
+                node.is_ready = False
+
+        raise ProverUnavailableError(f'No prover node is available, tried: {sorted(tried)}')
+
+    def _pick_node(self, exclude: set[str]) -> ProverNode | None:
+        nodes = [node for node in self.nodes if node.is_ready and node.url not in exclude]
+        if not nodes:
+            return None
+        # NOTE: random tie-breaking spreads requests between idle nodes
+        return min(nodes, key=lambda node: (node.score, random.random()))
+
+    async def _refresh_nodes(self) -> bool:
+        await asyncio.gather(*(node.refresh_status() for node in self.nodes))
+        return any(node.is_ready for node in self.nodes)
+
+    async def _refresh_periodically(self):
+        while True:
+            await asyncio.sleep(conf.PROVER_NODE_STATUS_INTERVAL)
+            if not await self._refresh_nodes():
+                logger.error('No prover node is ready ⭕')
@@ -0,0 +1,73 @@
+import path from 'path';
+import { fileURLToPath } from 'url';
+import { Noir } from '@noir-lang/noir_js';
+import fs from 'fs';
+
+// Long-lived witness generator. Circuits are loaded once, requests are read from stdin.
+//
+// request frame:  [uint32 BE length][JSON {"is_2048_sig": bool, "input": {...prover data...}}]
+// response frame: [uint8 status][uint32 BE length][payload]
+//   status 0 - payload is the gzipped witness (the first frame is a "ready" handshake)
+//   status 1 - payload is an utf-8 error message
+
+const STATUS_OK = 0;
+const STATUS_ERROR = 1;
+
+// NOTE: stdout is reserved for response frames
+console.log = console.error;
+
+
+function readJsonFile(filePath) {
+  return JSON.parse(fs.readFileSync(filePath));
+}
+
+
+function writeFrame(status, payload) {
+  const header = Buffer.alloc(5);
+  header.writeUInt8(status, 0);
+  header.writeUInt32BE(payload.length, 1);
+  process.stdout.write(Buffer.concat([header, payload]));
+}
+
+
+async function handleRequest(noir1024, noir2048, payload) {
+  try {
+    const request = JSON.parse(payload.toString('utf-8'));
+    const noir = request.is_2048_sig ? noir2048 : noir1024;
+    const { witness } = await noir.execute(request.input);
+    writeFrame(STATUS_OK, Buffer.from(witness));
+  } catch (error) {
+    writeFrame(STATUS_ERROR, Buffer.from(String(error?.stack || error), 'utf-8'));
+  }
+}
+
+
+function main() {
+  const __dirname = path.dirname(fileURLToPath(import.meta.url));
+
+  const noir1024 = new Noir(readJsonFile(path.join(__dirname, '..', 'target', 'samm_1024.json')));
+  const noir2048 = new Noir(readJsonFile(path.join(__dirname, '..', 'target', 'samm_2048.json')));
+
+  let buffer = Buffer.alloc(0);
+  // requests are executed one by one in the order of arrival
+  let queue = Promise.resolve();
+
+  process.stdin.on('data', (chunk) => {
+    buffer = Buffer.concat([buffer, chunk]);
+    while (buffer.length >= 4) {
+      const length = buffer.readUInt32BE(0);
+      if (buffer.length < 4 + length) {
+        break;
+      }
+      const payload = buffer.subarray(4, 4 + length);
+      buffer = buffer.subarray(4 + length);
+      queue = queue.then(() => handleRequest(noir1024, noir2048, payload));
+    }
+  });
+  // the relayer closes stdin on shutdown
+  process.stdin.on('end', () => queue.then(() => process.exit(0)));
+
+  writeFrame(STATUS_OK, Buffer.from('ready', 'utf-8'));
+}
+
+main();
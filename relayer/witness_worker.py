@@ -0,0 +1,147 @@
+import asyncio
+import json
+import os
+import struct
+
+import conf
+from logger import logger
+
+current_file_path = os.path.dirname(__file__)
+WITNESS_WORKER_FILENAME = os.path.join(current_file_path, 'scripts/witnessWorker.js')
+
+# see scripts/witnessWorker.js for the frame format
+REQUEST_HEADER = struct.Struct('>I')
+RESPONSE_HEADER = struct.Struct('>BI')
+STATUS_OK = 0
+STATUS_ERROR = 1
+
+
+class WitnessWorkerError(Exception):
+    """The worker process is broken and must be restarted."""
+
+
+class WitnessGenerationError(Exception):
+    """The worker is alive, but the circuit execution is failed."""
+
+
+class WitnessWorker:
+    """A node process with both circuits loaded, which generates witnesses on request."""
+
+    def __init__(self, idx: int):
+        self.idx = idx
+        self.process: asyncio.subprocess.Process | None = None
+        self._stderr_task: asyncio.Task | None = None
+
+    @property
+    def is_running(self) -> bool:
+        return self.process is not None and self.process.returncode is None
+
+    async def start(self):
+        logger.info(f'Start witness worker #{self.idx}')
+        self.process = await asyncio.create_subprocess_exec(
+            'node',
+            WITNESS_WORKER_FILENAME,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        self._stderr_task = asyncio.create_task(self._log_stderr())
+
+        # wait for circuits loading
+        status, payload = await self._read_frame()
+        if status != STATUS_OK:
+            raise WitnessWorkerError(f'Witness worker #{self.idx} is not started: {payload}')
+        logger.info(f'Witness worker #{self.idx} is ready')
+
+    async def stop(self):
+        if not self.is_running:
+            return
+        self.process.stdin.close()
+        try:
+            await asyncio.wait_for(self.process.wait(), 5)
+        except asyncio.TimeoutError:
+            self.process.kill()
+            await self.process.wait()
+
+    def kill(self):
+        if self.is_running:
+            self.process.kill()
+        if self._stderr_task:
+            self._stderr_task.cancel()
+
+    async def generate_witness(self, prover_data: dict, is_2048_sig: bool) -> bytes:
+        request = json.dumps({'is_2048_sig': is_2048_sig, 'input': prover_data}).encode()
+        self.process.stdin.write(REQUEST_HEADER.pack(len(request)) + request)
+        await self.process.stdin.drain()
+
+        status, payload = await self._read_frame()
+        if status != STATUS_OK:
+            raise WitnessGenerationError(payload.decode(errors='replace'))
+        return payload
+
+    async def _read_frame(self) -> tuple[int, bytes]:
+        try:
+            header = await self.process.stdout.readexactly(RESPONSE_HEADER.size)
+            status, length = RESPONSE_HEADER.unpack(header)
+            payload = await self.process.stdout.readexactly(length)
+        except asyncio.IncompleteReadError:
+            raise WitnessWorkerError(f'Witness worker #{self.idx} exited unexpectedly')
+        return status, payload
+
+    async def _log_stderr(self):
+        async for line in self.process.stderr:
+            logger.warning(f'Witness worker #{self.idx}: {line.decode(errors="replace").rstrip()}')
+
+
+class WitnessWorkerPool:
+    def __init__(self, size: int):
+        self.size = size
+        self._workers = [WitnessWorker(idx) for idx in range(size)]
+        self._idle: asyncio.Queue[WitnessWorker] | None = None
+        self._lock = asyncio.Lock()
+
+    async def start(self):
+        async with self._lock:
+            if self._idle is not None:
+                return
+            results = await asyncio.gather(*(worker.start() for worker in self._workers), return_exceptions=True)
+            for worker, result in zip(self._workers, results):
+                if isinstance(result, BaseException):
+                    logger.error(f'Witness worker #{worker.idx} is failed to start: {result}')
+                    worker.kill()
+
+            # NOTE: the prover is not ready without workers, failed workers are restarted on demand otherwise
+            if all(isinstance(result, BaseException) for result in results):
+                raise WitnessWorkerError(f'No witness worker is started: {results[0]}')
+
+            self._idle = asyncio.Queue()
+            for worker in self._workers:
+                self._idle.put_nowait(worker)
+
+    async def stop(self):
+        await asyncio.gather(*(worker.stop() for worker in self._workers))
+        self._idle = None
+
+    async def generate_witness(self, prover_data: dict, is_2048_sig: bool) -> bytes:
+        await self.start()
+
+        worker = await self._idle.get()
+        try:
+            if not worker.is_running:
+                await worker.start()
+            return await worker.generate_witness(prover_data, is_2048_sig)
+        except WitnessGenerationError:
+            raise
+        except:
+            # NOTE: the worker state is unknown after a failure, it is restarted on the next request
+            worker.kill()
+            raise
+        finally:
+            self._idle.put_nowait(worker)
+
+
+POOL = WitnessWorkerPool(conf.WITNESS_WORKERS)
+
+
+async def generate_witness(prover_data: dict, is_2048_sig: bool) -> bytes:
+    return await POOL.generate_witness(prover_data, is_2048_sig)
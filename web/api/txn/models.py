@@ -76,6 +76,11 @@ class Approval(ApprovalBase, table=True):
 class ApprovalPublic(ApprovalBase):
     id: int
 
+    @field_serializer('proof')
+    def serialize_proof(self, proof: bytes):
+        # NOTE: proofs are stored as raw bytes, the API returns them hex encoded as before
+        return proof.hex()
+
     @field_serializer('commit')
     def serialize_commit(self, commit: bytes):
         return int.from_bytes(commit)